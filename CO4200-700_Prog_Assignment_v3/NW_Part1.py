@@ -1,5 +1,10 @@
 import sys
-import blosum as bl
+import banded
+import dp_engine
+import dp_scores
+import linear_space
+import substitution
+import traceback_store
 
 """
 Needleman-Wunsch algorithm for global alignment.
@@ -9,12 +14,13 @@ class Alignment(object):
     y = None # second sequence
     xa = None # will be te first sequence after inserting gaps
     ya = None # and the second sequence after inserting gaps
+    xc = None # first sequence as residue codes
+    yc = None # second sequence as residue codes
 
     d = 8 # gap penalty
     columns = 80 # this no. cols for displaying the original output in shown part2
-
-    # BLOSUM50 substitution matrix from blosum package
-    blosum_50 = bl.BLOSUM(50, default=0)
+    engine = "numpy" # "numpy" for the vectorised fill in dp_engine, "python" for the reference loops
+    dp_workers = 1 # processes for the tiled wavefront fill of one long alignment (None: all CPUs)
 
     # __init__ method that sets up the value for variables used in the class
     def __init__(self, s1, s2):
@@ -22,10 +28,16 @@ class Alignment(object):
         self.y = s2 # stores s2 in Y
         self.xa = None # set xa to null
         self.ya = None # setya to null
+        # sequences are validated and encoded once here, every engine works on the codes
+        self.xc = substitution.encode(s1)
+        self.yc = substitution.encode(s2)
 
-    # substitution score for character pairs
+    # substitution score for character pairs, looked up in the shared BLOSUM50 table
     def s(self, x, y):
-        return Alignment.blosum_50[x][y]
+        score = substitution.table(Alignment.d).s(x, y)
+        if score is None:
+            raise ValueError("s(x,y) called for illegal character")
+        return float(score)
 
     # gap penalty function
     @staticmethod
@@ -102,14 +114,87 @@ class Alignment(object):
         return score
 
     # compute alignment between sequences X and Y
+    # uses the NumPy engine unless engine is set to "python"
     def compute_alignment(self):
+        if Alignment.engine == "python":
+            self.compute_alignment_reference()
+            return
+        score, xa, ya = dp_engine.align(self.xc, self.yc, Alignment.d, Alignment.dp_workers)
+        self.xa = list(xa)
+        self.ya = list(ya)
+
+    # score of the optimal alignment, computed with two rows of F and no traceback
+    def compute_score(self):
+        table = substitution.table(Alignment.d).residues
+        return float(linear_space.scores_many(self.xc, [self.yc], table, Alignment.d)[0])
+
+    # score, exact matches and positions scored (no gap) of the optimal alignment,
+    # computed in linear memory without storing xa and ya
+    def compute_identity(self):
+        score, matches, scored = linear_space.score_and_counts(
+            self.xc, self.yc, substitution.table(Alignment.d).residues, Alignment.d)
+        return float(score), matches, scored
+
+    # score of the best local (Smith-Waterman) alignment of any part of x with any part of y
+    def compute_local_score(self):
+        table = substitution.table(Alignment.d).residues
+        return float(linear_space.scores_many(self.xc, [self.yc], table, Alignment.d, local=True)[0])
+
+    # scores of the optimal alignments of query against every target, one float per target;
+    # the targets are aligned together, each step of the DP advancing all of them at once
+    @staticmethod
+    def score_many(query, targets):
+        return [score for score, _, _ in Alignment.identity_many(query, targets)]
+
+    # compute_identity of query against every target, as a list of (score, matches, scored)
+    @staticmethod
+    def identity_many(query, targets):
+        scores, matches, scored = linear_space.score_and_counts_many(
+            substitution.encode(query), [substitution.encode(y) for y in targets],
+            substitution.table(Alignment.d).residues, Alignment.d)
+        return [(float(s), int(a), int(b)) for s, a, b in zip(scores, matches, scored)]
+
+    # same alignment as compute_alignment, but found by divide and conquer (Hirschberg)
+    # so only O(n + m) of F is held at any time
+    def compute_alignment_hirschberg(self):
+        ops = linear_space.hirschberg(self.xc, self.yc, substitution.table(Alignment.d).residues, Alignment.d)
+        xa, ya = dp_engine.apply_moves(self.xc, self.yc, ops)
+        self.xa = list(substitution.decode(xa))
+        self.ya = list(substitution.decode(ya))
+
+    # banded alignment for similar sequences: only diagonals near the length difference and
+    # shared k-mers are filled (or width diagonals either side when width is given), and the
+    # band is widened whenever the traceback runs along its edge or an edge is within the
+    # X drop of its row's best score (see banded.py)
+    def compute_alignment_banded(self, width=None):
+        score, ops = banded.align_pairwise(self.xc, self.yc, substitution.table(Alignment.d).residues,
+                                           Alignment.d, dp_engine.pairwise_move, width)
+        xa, ya = dp_engine.apply_moves(self.xc, self.yc, ops)
+        self.xa = list(substitution.decode(xa))
+        self.ya = list(substitution.decode(ya))
+
+    # same alignment as compute_alignment keeping only every k-th row of F (default about
+    # sqrt(len(x))), blocks of rows are filled again during the traceback
+    def compute_alignment_checkpointed(self, k=None):
+        scores = dp_scores.PairScores(self.xc, self.yc, substitution.table(Alignment.d).residues, Alignment.d)
+        _, ops = traceback_store.align_checkpointed(scores, traceback_store.PAIRWISE, k)
+        xa, ya = dp_engine.apply_moves(self.xc, self.yc, ops)
+        self.xa = list(substitution.decode(xa))
+        self.ya = list(substitution.decode(ya))
+
+    # pure Python Needleman-Wunsch, kept as the reference the NumPy engine is checked against
+    def compute_alignment_reference(self):
         # constants for remembering T/L/D in P matrix
         t = 1
         l = 2
         d = 3
 
-        n = len(self.x) # length of X / number of chars in X
-        m = len(self.y) # length of Y / number of chars in Y
+        # the loops work on characters, so encoded sequences (store views) are decoded first
+        x = self.x if isinstance(self.x, str) else substitution.decode(self.xc)
+        y = self.y if isinstance(self.y, str) else substitution.decode(self.yc)
+
+        n = len(x) # length of X / number of chars in X
+        m = len(y) # length of Y / number of chars in Y
 
         # instantiates the matrices F and P
         f = [[0] * (m + 1) for _ in range(n + 1)]
@@ -130,7 +215,7 @@ class Alignment(object):
                     p[i][j] = t
                 else:
 
-                    diag = f[i - 1][j - 1] + self.s(self.x[i - 1], self.y[j - 1])
+                    diag = f[i - 1][j - 1] + self.s(x[i - 1], y[j - 1])
                     left = f[i][j - 1] - Alignment.d
                     top = f[i - 1][j] - Alignment.d
                     if diag >= left and diag >= top:
@@ -152,17 +237,17 @@ class Alignment(object):
         j = m
         while i + j > 0:
             if p[i][j] == d:
-                xb.insert(0, self.x[i - 1])
-                yb.insert(0, self.y[j - 1])
+                xb.insert(0, x[i - 1])
+                yb.insert(0, y[j - 1])
                 i -= 1
                 j -= 1
             elif p[i][j] == t:
-                xb.insert(0, self.x[i - 1])
+                xb.insert(0, x[i - 1])
                 yb.insert(0, '-')
                 i -= 1
             else:
                 xb.insert(0, '-')
-                yb.insert(0, self.y[j - 1])
+                yb.insert(0, y[j - 1])
                 j -= 1
         self.xa = xb
         self.ya = yb
@@ -1,51 +1,26 @@
 import numpy as np
-from NW_Part1 import Alignment
+import all_pairs
+from sequence_store import SequenceStore
 
 
 #### 2
-# reading  and initializing a list to hold the sequences and adding them in a list
-ListOfSequences = []
-multipleSequencesFile = open("./sequences/multiple3.txt", "r")
-#first line of the file is how many sequences are there
-sequencesNumber = multipleSequencesFile.readline().strip()
-
-if sequencesNumber.isnumeric():
-    sequencesNumber = int(sequencesNumber)
-
-# read the rest of file  and append sequences in the list
-for i in range(0, sequencesNumber+1):
-    x = multipleSequencesFile.readline().strip()
-    if x != "":
-        ListOfSequences.append(x)
-
-#close file to save resources
-multipleSequencesFile.close()
-
 # function returns a matrix that when taking a list of sequences returns
 # a matrix of their scores.sequence i and j can be found in the Matrix in position (i,j)
 # computes the alignment for any pair of sequences even with itself
+#
+# the matrix is symmetric, so only pairs i < j are aligned (spread over a process pool)
+# and mirrored, the scores of sequences with themselves come straight from BLOSUM50
 def GetScoresForPairs(SequenceList):
-
-    tempMatrix = []
-    for sequence1 in SequenceList:
-        TempList = []
-        for sequence2 in SequenceList:
-
-            pair = Alignment(sequence1, sequence2)
-            pair.compute_alignment()
-            TempList.append(pair.score_alignment())
-        tempMatrix.append(TempList)
-    return tempMatrix
-
-#calling the function and saving it in variable
-ScoreMatrix = GetScoresForPairs(ListOfSequences)
-# making the list an array to print it with its build in function
-print(np.array(ScoreMatrix))
-
-
-
-
-
+    return all_pairs.score_matrix(SequenceList)
 
 
+# the script part only runs when Part2.py is executed, so pool workers can import it safely
+if __name__ == "__main__":
+    # reading  and initializing a list to hold the sequences and adding them in a list
+    # sequences are streamed from the file already stripped, validated and encoded
+    ListOfSequences = SequenceStore.from_file("./sequences/multiple3.txt")
 
+    #calling the function and saving it in variable
+    ScoreMatrix = GetScoresForPairs(ListOfSequences)
+    # making the list an array to print it with its build in function
+    print(np.array(ScoreMatrix))
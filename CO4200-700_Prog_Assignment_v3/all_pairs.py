@@ -0,0 +1,204 @@
+import heapq
+import math
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+import linear_space
+import matrix_cache
+import pair_cache
+import substitution
+from NW_Part1 import Alignment
+
+"""
+All-pairs engine for the pairwise score and Kimura distance matrices.
+
+Both matrices are symmetric, so only the upper triangle is aligned and then
+mirrored. The diagonal is derived without any DP. The remaining pairs are
+grouped into batches of one sequence against up to BATCH others, each aligned
+in one vectorised pass (linear_space.score_and_counts_many), and the batches
+are split into chunks of roughly equal cost (len(x) * len(y) cells) that are
+run on a process pool. Score and identity counts come out of the same DP, so every
+computed pair goes into the shared pair cache and serves both matrices. With
+an on-disk matrix_cache, pairs of earlier runs are read from disk and the
+results of this run are saved there for the next one.
+"""
+
+# below this many DP cells the pool costs more than it saves
+PARALLEL_CELLS = 2000000
+
+# most targets aligned against one sequence in a single vectorised pass
+BATCH = 64
+
+# chunks per worker, more chunks even out the tail at the cost of more messages
+CHUNKS_PER_WORKER = 4
+
+_sequences = None
+_safe_codes = None
+
+
+# Kimura distance from the exact matches and positions scored of an alignment
+def kimura(matches, scored):
+    S = matches / scored
+    D = 1 - S
+    return -math.log(1 - D - 0.2 * (D ** 2))
+
+
+# residue codes for which aligning a sequence with itself is guaranteed to give
+# the plain ungapped alignment: s(a, b) <= (s(a, a) + s(b, b)) / 2 for every
+# b in the set means no gapped or shifted alignment can beat the diagonal
+def safe_codes(table):
+    global _safe_codes
+    if _safe_codes is None:
+        self_scores = np.diag(table)
+        ok = 2 * table <= self_scores[:, None] + self_scores[None, :]
+        _safe_codes = ok.all(axis=1)
+    return _safe_codes
+
+
+# value for a sequence aligned with itself, from the diagonal of the table when possible
+def _self_value(kind, x, table, d):
+    if len(x) > 0 and safe_codes(table)[x].all():
+        if kind == "score":
+            return float(table[x, x].sum())
+        return kimura(len(x), len(x))
+    return _value(kind, _align(x, x, table, d))
+
+
+def _align(x, y, table, d):
+    return pair_cache.PairResult(*linear_space.score_and_counts(x, y, table, d))
+
+
+def _value(kind, result):
+    if kind == "score":
+        return float(result.score)
+    return kimura(result.matches, result.scored)
+
+
+def _init_worker(sequences):
+    global _sequences
+    _sequences = sequences
+
+
+def _run_chunk(d, batches):
+    table = substitution.table(d).residues
+    out = []
+    for i, js in batches:
+        results = linear_space.score_and_counts_many(_sequences[i], [_sequences[j] for j in js], table, d)
+        out.extend((i, j, pair_cache.PairResult(int(s), int(a), int(b)))
+                   for j, s, a, b in zip(js, *results))
+    return out
+
+
+# groups pairs (i, j) into batches (i, [j, ...]) of at most BATCH targets, targets
+# of similar length together so little of the padded array is wasted
+def batches(pairs, lengths):
+    targets = {}
+    for i, j in pairs:
+        targets.setdefault(i, []).append(j)
+    out = []
+    for i, js in targets.items():
+        js.sort(key=lambda j: lengths[j])
+        for k in range(0, len(js), BATCH):
+            out.append((i, js[k:k + BATCH]))
+    return out
+
+
+# splits the batches into chunks of similar total cost, costliest first
+# (greedy longest-processing-time assignment), so no worker is left with a
+# few long batches at the end
+def schedule(batches, lengths, chunks):
+    cost = lambda batch: (lengths[batch[0]] + 1) * (max(lengths[j] for j in batch[1]) + 1) * len(batch[1])
+    ordered = sorted(batches, key=cost, reverse=True)
+    heap = [(0, k) for k in range(chunks)]
+    out = [[] for _ in range(chunks)]
+    for batch in ordered:
+        load, k = heapq.heappop(heap)
+        out[k].append(batch)
+        heapq.heappush(heap, (load + cost(batch), k))
+    return [chunk for chunk in out if chunk]
+
+
+# symmetric matrix of kind "score" (alignment scores) or "kimura" (distances)
+# for every pair of sequences, returned as a list of lists like the loops it replaces
+#
+# workers defaults to the number of CPUs, workers=1 runs everything in this process;
+# cache=None turns the pair cache off
+#
+# disk is a matrix_cache.MatrixCache, by default the one MSA_CACHE_DIR names (if any)
+def all_pairs(SequenceList, kind, workers=None, cache=pair_cache.shared, disk=None):
+    if kind not in ("score", "kimura"):
+        raise ValueError("unknown matrix kind " + repr(kind))
+    d = Alignment.d
+    table = substitution.table(d).residues
+    sequences = [substitution.encode(seq) for seq in SequenceList]
+    n = len(sequences)
+    lengths = [len(x) for x in sequences]
+
+    matrix = [[0.0] * n for _ in range(n)]
+    i = 0
+    while i < n:
+        matrix[i][i] = _self_value(kind, sequences[i], table, d)
+        i += 1
+
+    if disk is None:
+        disk = matrix_cache.from_environment()
+    if disk is not None and n > 1:
+        keys = matrix_cache.hashes(sequences)
+        params = matrix_cache.parameters("nw", d)
+        known, values = disk.lookup(keys, params)
+    else:
+        disk = None
+        known = None
+
+    pairs = []
+    found = []
+    for i in range(n):
+        for j in range(i + 1, n):
+            if known is not None and known[i, j]:
+                result = pair_cache.PairResult(*(int(v) for v in values[:, i, j]))
+            else:
+                result = cache.get(sequences[i], sequences[j], "nw", d) if cache is not None else None
+            if result is None:
+                pairs.append((i, j))
+            else:
+                found.append((i, j, result))
+                matrix[i][j] = matrix[j][i] = _value(kind, result)
+
+    if workers is None:
+        workers = os.cpu_count() or 1
+    cells = sum((lengths[i] + 1) * (lengths[j] + 1) for i, j in pairs)
+    work = batches(pairs, lengths)
+    if workers <= 1 or len(work) <= 1 or cells < PARALLEL_CELLS:
+        _init_worker(sequences)
+        results = [_run_chunk(d, work)]
+    else:
+        chunks = schedule(work, lengths, workers * CHUNKS_PER_WORKER)
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                                 initargs=(sequences,)) as pool:
+            results = list(pool.map(_run_chunk, [d] * len(chunks), chunks))
+
+    for chunk in results:
+        for i, j, result in chunk:
+            if cache is not None:
+                cache.put(sequences[i], sequences[j], "nw", d, result)
+            matrix[i][j] = matrix[j][i] = _value(kind, result)
+
+    # the whole set goes back to disk unless every pair of distinct sequences came from there
+    if disk is not None and not all(known[i, j] or keys[i] == keys[j] for i in range(n) for j in range(i + 1, n)):
+        for chunk in results + [found]:
+            for i, j, result in chunk:
+                values[:, i, j] = values[:, j, i] = (result.score, result.matches, result.scored)
+        disk.store(keys, params, values)
+    return matrix
+
+
+# pairwise alignment scores, as Part2.GetScoresForPairs
+def score_matrix(SequenceList, workers=None):
+    return all_pairs(SequenceList, "score", workers)
+
+
+# Kimura distances, as Part3i.Kimuradistance
+def kimura_matrix(SequenceList, workers=None):
+    return all_pairs(SequenceList, "kimura", workers)
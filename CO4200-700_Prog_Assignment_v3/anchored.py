@@ -0,0 +1,147 @@
+import numpy as np
+
+import banded
+import frequency_profile
+import instrumentation
+from dp_engine import DIAG, LEFT, TOP
+from frequency_profile import consensus
+from substitution import GAP
+
+"""
+Anchored profile alignment for well-conserved families.
+
+Blocks the two profiles share are found as exact k-mer matches between their
+consensus sequences: the k-mers of X are hashed and sorted once, each k-mer
+of Y is looked up in that index, and hits on the same diagonal that follow
+each other are joined into one maximal match. A DP over the matches picks the
+collinear chain (both ends increasing) with the most matched columns, less
+one per diagonal it shifts between matches. The chained matches, less TRIM
+columns at either end so the DP can settle their exact edges, are the
+anchors: their columns are aligned to each other directly and the profile DP
+only fills the rectangles between consecutive anchors.
+
+With gap scores linear, the result is the best alignment through the anchors.
+It is the optimal one whenever the optimal path runs through them, which is
+the case for blocks conserved across the family, and time and memory fall
+from the whole matrix to the sum of the rectangles between anchors.
+"""
+
+K = 6 # k-mer length of the matches
+TRIM = 2 # columns left to the DP at either end of every anchor
+MAX_REPEATS = 4 # k-mers more frequent than this in either consensus are not used as anchors
+MAX_MATCHES = 2000 # longest matches kept for chaining
+
+
+# maximal exact matches of at least k codes between encoded x and y, as arrays of the start
+# in x, start in y and length; k-mers holding a gap or repeated too often are left out
+def matches(x, y, k=K):
+    hx = banded.kmers(x, k)
+    hy = banded.kmers(y, k)
+    empty = np.empty(0, dtype=np.int64)
+    if len(hx) == 0 or len(hy) == 0:
+        return empty, empty, empty
+    # a k-mer holds a gap if a gap starts in its window
+    gaps = np.concatenate(([0], np.cumsum(x == GAP)))
+    hx[gaps[k:] - gaps[:-k] > 0] = -1
+    gaps = np.concatenate(([0], np.cumsum(y == GAP)))
+    hy[gaps[k:] - gaps[:-k] > 0] = -2
+
+    # index of x: its k-mers sorted, every lookup a range of that order
+    order = np.argsort(hx, kind='stable')
+    sorted_hx = hx[order]
+    lo = np.searchsorted(sorted_hx, hy, side='left')
+    hi = np.searchsorted(sorted_hx, hy, side='right')
+    _, inverse, repeats = np.unique(hy, return_inverse=True, return_counts=True)
+    use = (hy >= 0) & (hi - lo > 0) & (hi - lo <= MAX_REPEATS) & (repeats[inverse] <= MAX_REPEATS)
+    count = (hi - lo) * use
+    if count.sum() == 0:
+        return empty, empty, empty
+    yi = np.repeat(np.arange(len(hy)), count)
+    first = np.repeat(lo, count) + np.arange(count.sum()) - np.repeat(np.cumsum(count) - count, count)
+    xi = order[first]
+
+    # hits next to each other on one diagonal make one match
+    diagonal = yi - xi
+    hit = np.lexsort((xi, diagonal))
+    xi = xi[hit]
+    yi = yi[hit]
+    diagonal = diagonal[hit]
+    starts = np.concatenate(([True], (np.diff(diagonal) != 0) | (np.diff(xi) != 1)))
+    begin = np.flatnonzero(starts)
+    end = np.concatenate((begin[1:], [len(xi)]))
+    return xi[begin].astype(np.int64), yi[begin].astype(np.int64), (end - begin + k - 1).astype(np.int64)
+
+
+# indices of the collinear chain of matches with the highest total length less the
+# diagonal shifts between consecutive matches, in order
+def chain(xi, yi, length):
+    if len(xi) == 0:
+        return []
+    if len(xi) > MAX_MATCHES:
+        keep = np.sort(np.argsort(-length, kind='stable')[:MAX_MATCHES])
+        return [int(keep[a]) for a in chain(xi[keep], yi[keep], length[keep])]
+    order = np.lexsort((yi, xi))
+    xi = xi[order]
+    yi = yi[order]
+    length = length[order]
+    diagonal = yi - xi
+    x_end = xi + length
+    y_end = yi + length
+    best = length.copy()
+    back = np.full(len(xi), -1, dtype=np.int64)
+    a = 1
+    while a < len(xi):
+        # matches that end before this one starts in both profiles
+        before = np.flatnonzero((x_end[:a] <= xi[a]) & (y_end[:a] <= yi[a]))
+        if len(before):
+            value = best[before] - np.abs(diagonal[before] - diagonal[a])
+            b = int(np.argmax(value))
+            if value[b] > 0:
+                best[a] += value[b]
+                back[a] = before[b]
+        a += 1
+    out = []
+    a = int(np.argmax(best))
+    while a >= 0:
+        out.append(int(order[a]))
+        a = int(back[a])
+    out.reverse()
+    return out
+
+
+# anchors for aligning profiles with column counts cX and cY, as a list of
+# (start in X, start in Y, length), collinear and apart from each other
+def anchors(cX, cY, k=K):
+    xi, yi, length = matches(consensus(cX), consensus(cY), k)
+    out = []
+    for a in chain(xi, yi, length):
+        if length[a] > 2 * TRIM:
+            out.append((int(xi[a]) + TRIM, int(yi[a]) + TRIM, int(length[a]) - 2 * TRIM))
+    return out
+
+
+# traceback moves of aligning two profiles through the anchors, as frequency_profile.alignment_moves
+def alignment_moves(cX, nX, cY, nY, table, k=K):
+    n = cX.shape[0]
+    m = cY.shape[0]
+    parts = []
+    cells = 0
+    anchored = 0
+    i = 0
+    j = 0
+    for ai, aj, length in anchors(cX, cY, k) + [(n, m, 0)]:
+        if ai == i or aj == j:
+            # one side of the rectangle is empty, the other is all gaps
+            parts.append(np.full(ai - i, TOP, dtype=np.uint8))
+            parts.append(np.full(aj - j, LEFT, dtype=np.uint8))
+        else:
+            parts.append(frequency_profile.alignment_moves(cX[i:ai], nX, cY[j:aj], nY, table))
+            cells += (ai - i + 1) * (aj - j + 1)
+        parts.append(np.full(length, DIAG, dtype=np.uint8))
+        anchored += length
+        i = ai + length
+        j = aj + length
+    if instrumentation.enabled:
+        instrumentation.count("anchored_cells", cells)
+        instrumentation.count("anchored_columns", anchored)
+    return np.concatenate(parts)
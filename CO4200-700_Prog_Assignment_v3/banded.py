@@ -0,0 +1,224 @@
+import numpy as np
+
+import dp_scores
+import instrumentation
+import traceback_store
+from dp_engine import DIAG, LEFT, TOP
+from substitution import SIZE
+
+"""
+Banded alignment for highly similar sequences and profiles.
+
+Only cells whose diagonal j - i lies in [lo, hi] are filled, so time and
+memory are O(L * w) for a band of w diagonals. The band is chosen from the
+length difference and the diagonals of the chain of exact matches the two
+share. The band is widened and the alignment retried while the traceback
+runs along its edge, or while the X-drop rule (as in BLAST's gapped
+extension) finds a band edge that is not yet X below the best F of its row:
+a path through such a cell could still catch up with the best one, so the
+band stops short of where the optimal path might go. Past the X drop, the
+path outside the band would have to gain more than XDROP gaps back on
+diagonals with no shared matches, and the banded alignment is the full
+fill's. Once the band needed is wider than FULL of the matrix's diagonals,
+the full fill is cheaper and is run instead.
+"""
+
+K = 4 # k-mer length used to find the diagonals of similar regions
+PAD = 8 # extra diagonals on both sides of the k-mer hits
+NEG = -(1 << 60) # score of cells outside the band
+FULL = 0.5 # fraction of the diagonals past which the full fill is run instead of a band
+XDROP = 16 # X of the X-drop rule, in gaps
+ROWS = 64 # rows of the band filled from one block of scores
+
+
+# k-mer hashes of an encoded sequence, one per start position
+def kmers(codes, k=K):
+    n = len(codes) - k + 1
+    if n <= 0:
+        return np.empty(0, dtype=np.int64)
+    h = np.zeros(n, dtype=np.int64)
+    q = 0
+    while q < k:
+        h = h * SIZE + codes[q:q + n]
+        q += 1
+    return h
+
+
+# diagonal range [lo, hi] for aligning x to y: always holds the main diagonal and
+# the diagonal of the end cell, plus the diagonals of the exact matches of K or more
+# codes the two share
+#
+# only the collinear chain of matches anchored.chain picks is used, so chance matches
+# far from the real path do not blow the band up
+def band_limits(x, y, pad=PAD):
+    import anchored # imports this module
+    n = len(x)
+    m = len(y)
+    lo = min(0, m - n)
+    hi = max(0, m - n)
+    xi, yi, length = anchored.matches(x, y, K)
+    picked = anchored.chain(xi, yi, length)
+    if picked:
+        diags = (yi - xi)[picked]
+        lo = min(lo, int(diags.min()))
+        hi = max(hi, int(diags.max()))
+    return max(lo - pad, -n), min(hi + pad, m)
+
+
+# fills the band of diagonals [lo, hi] of the matrix of scores (a dp_scores.PairScores
+# or ProfileScores); P is stored per row from diagonal lo, so cell (i, j) is p[i, j - i - lo]
+#
+# F is held as H = F - G, with G(j) the sum of the gap scores in X of columns 1 .. j (row 0
+# of F), so the gaps along a row are one running maximum; ROWS rows at a time, the scores
+# of the band's cells are taken from one rectangle and the direction bits found at once
+#
+# returns the score, P, F of every row on diagonals lo and hi (NEG where outside the
+# matrix) and the best F of every row
+def fill(scores, lo, hi):
+    top = scores.top
+    n = len(top)
+    m = len(scores.left)
+    w = hi - lo + 1
+    p = np.zeros((n + 1, w), dtype=np.uint8)
+    if instrumentation.enabled:
+        instrumentation.count("banded_cells", p.size)
+        instrumentation.count("dp_bytes", p.nbytes)
+    # G and the gap score in X of every column the band reaches, lo - 1 .. n + hi, from index 0
+    reach = np.clip(np.arange(lo - 1, n + hi + 1), 0, m)
+    G = scores.first_row[reach]
+    gap = np.concatenate(([0], np.diff(G)))
+    cols = np.arange(w)
+    low = np.full(n + 1, NEG, dtype=np.int64)
+    high = np.full(n + 1, NEG, dtype=np.int64)
+    best = np.empty(n + 1, dtype=np.int64)
+
+    # previous row of H with one NEG cell on each side for the neighbours outside the band
+    prev = np.full(w + 2, NEG, dtype=np.int64)
+    j = lo + cols
+    inside = (j >= 0) & (j <= m)
+    prev[1:w + 1][inside] = 0
+    p[0, inside & (j > 0)] = LEFT
+    f = np.where(inside, G[cols + 1], NEG)
+    low[0] = f[0]
+    high[0] = f[-1]
+    best[0] = f.max()
+    i0 = 1
+    while i0 <= n:
+        i1 = min(n + 1, i0 + ROWS)
+        r = i1 - i0
+        rows = np.arange(r)[:, None]
+        # columns of the cells of rows i0 .. i1 - 1, and their G offsets
+        j = i0 + lo + rows + cols
+        g = j - lo + 1
+        # substitution scores of the cells less the gap in X their diagonal neighbour is
+        # short of in H, NEG outside the matrix
+        rect = np.full((r, r + w - 1), NEG, dtype=np.int64)
+        c0 = max(1, i0 + lo)
+        c1 = min(m, i1 - 1 + hi)
+        if c0 <= c1:
+            rect[:, c0 - i0 - lo:c1 - i0 - lo + 1] = scores.diag(i0, i1, c0, c1 + 1)
+        e = rect[rows, rows + cols] - gap[g]
+        H = np.full((r + 1, w + 2), NEG, dtype=np.int64)
+        H[0] = prev
+        k = 0
+        while k < r:
+            i = i0 + k
+            row = H[k + 1, 1:w + 1]
+            np.add(H[k, 1:w + 1], e[k], out=row)
+            np.maximum(row, H[k, 2:w + 2] + top[i - 1], out=row)
+            if i + lo <= 0:
+                row[-i - lo] = scores.first_col[i]
+            np.maximum.accumulate(row, out=row)
+            k += 1
+        cur = H[1:, 1:w + 1]
+        bits = (cur == H[:-1, 1:w + 1] + e) * DIAG
+        bits |= (cur == H[:-1, 2:w + 2] + top[i0 - 1:i1 - 1, None]) * TOP
+        bits |= (cur == H[1:, :w]) * LEFT
+        bits[j == 0] = TOP
+        p[i0:i1] = bits
+        f = np.where((j >= 0) & (j <= m), cur + G[g], NEG)
+        low[i0:i1] = f[:, 0]
+        high[i0:i1] = f[:, -1]
+        best[i0:i1] = f.max(axis=1)
+        prev = H[-1]
+        i0 = i1
+    return int(prev[m - n - lo + 1] + G[m - lo + 1]), p, low, high, best
+
+
+# follows the banded P back from (n, m), returns the moves and whether the path
+# ran along the lo and the hi edge of the band where they cut the matrix
+def traceback(p, n, m, lo, hi, move):
+    w = hi - lo + 1
+    ops = []
+    touched_lo = False
+    touched_hi = False
+    i = n
+    j = m
+    while i + j > 0:
+        b = j - i - lo
+        if b == 0 and lo > -n:
+            touched_lo = True
+        if b == w - 1 and hi < m:
+            touched_hi = True
+        op = move(p[i, b])
+        ops.append(op)
+        if op != LEFT:
+            i -= 1
+        if op != TOP:
+            j -= 1
+    ops.reverse()
+    return np.array(ops, dtype=np.uint8), touched_lo, touched_hi
+
+
+# banded alignment starting from the band limits, returns the score and the moves
+#
+# while the traceback runs along an edge of the band, or F on an edge is within X of
+# the best F of its row in some row (x_drop, see XDROP), that edge is moved out by
+# half the band's width (at least PAD) and the band filled again
+#
+# full() gives the score and moves of the full fill, used once the band gets too wide
+def align(scores, limits, move, full):
+    n = len(scores.top)
+    m = len(scores.left)
+    lo, hi = limits
+    x = x_drop(scores.top, scores.left)
+    while True:
+        if hi - lo + 1 > FULL * (n + m + 1):
+            return full()
+        score, p, low, high, best = fill(scores, lo, hi)
+        ops, touched_lo, touched_hi = traceback(p, n, m, lo, hi, move)
+        grow_lo = lo > -n and (touched_lo or bool((low + x >= best).any()))
+        grow_hi = hi < m and (touched_hi or bool((high + x >= best).any()))
+        if not grow_lo and not grow_hi:
+            return score, ops
+        step = max(PAD, (hi - lo + 1) // 2)
+        if grow_lo:
+            lo = max(lo - step, -n)
+        if grow_hi:
+            hi = min(hi + step, m)
+
+
+# X of the X-drop rule: XDROP times the costliest gap of either sequence
+def x_drop(top, left):
+    return XDROP * -int(min(np.min(top, initial=0), np.min(left, initial=0)))
+
+
+# band limits around the length difference with width diagonals of padding
+def fixed_limits(n, m, width):
+    return max(min(0, m - n) - width, -n), min(max(0, m - n) + width, m)
+
+
+# score and moves of the full fill of scores, with the traceback priority order
+def _full(scores, order):
+    score, packed = traceback_store.fill_packed(scores, order)
+    return score, packed.traceback()
+
+
+# banded pairwise alignment of encoded x and y, returns the score and moves;
+# width fixes the padding around the length difference instead of using k-mer hits
+def align_pairwise(x, y, table, d, move, width=None):
+    n = len(x)
+    m = len(y)
+    limits = band_limits(x, y) if width is None else fixed_limits(n, m, width)
+    scores = dp_scores.PairScores(x, y, table, d)
+    return align(scores, limits, move, lambda: _full(scores, traceback_store.PAIRWISE))
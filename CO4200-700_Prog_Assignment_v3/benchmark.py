@@ -0,0 +1,259 @@
+import argparse
+import json
+import os
+import platform
+import random
+import resource
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+
+import all_pairs
+import guide_tree
+import kmer_distance
+import pair_cache
+import substitution
+from NW_Part1 import Alignment
+from multiple_Sequence_Alignment_Modified import MultipleAlignment
+from sequence_store import SequenceStore
+from sp_score import SPScorer
+
+"""
+Benchmarks for the alignment engines.
+
+Every phase (pairwise alignment, full and banded, all-pairs score matrix,
+Kimura distances, guide tree, progressive MSA, sum-of-pairs scoring and the
+incremental score changes of SPScorer) is run on the bundled sequence sets
+and on synthetic families of longer sequences. For each phase
+the best wall time of a few runs is reported together with DP cells per
+second where the phase is a DP, then one more run under tracemalloc gives the
+peak Python/NumPy allocation and the process RSS after it.
+
+    python benchmark.py --output bench.json
+    python benchmark.py --compare bench.json --threshold 0.2
+
+The comparison run exits with status 1 if any phase got slower (or used more
+memory) than the baseline by more than the threshold.
+"""
+
+SETS = [1, 2, 3, 10, 32, 64, 128]
+
+# synthetic families as (sequences, ancestor length)
+SYNTHETIC = [(16, 500), (8, 2000)]
+
+PHASES = ["pairwise", "banded", "score_matrix", "kimura", "guide_tree", "msa", "sp_score", "sp_delta"]
+
+# phases faster than this are too noisy to compare
+MIN_SECONDS = 0.01
+
+RESIDUES = "ARNDCQEGHILKMFPSTWYV"
+
+
+# n related sequences: random point mutations and short indels of one random ancestor
+def synthetic_family(n, length, seed=0, mutation=0.15, indel=0.02):
+    rng = random.Random(seed)
+    ancestor = [rng.choice(RESIDUES) for _ in range(length)]
+    family = []
+    for _ in range(n):
+        seq = []
+        for ch in ancestor:
+            r = rng.random()
+            if r < indel / 2:
+                continue
+            seq.append(rng.choice(RESIDUES) if r < mutation else ch)
+            if rng.random() < indel / 2:
+                seq.extend(rng.choice(RESIDUES) for _ in range(rng.randint(1, 4)))
+        family.append("".join(seq))
+    return family
+
+
+# DP cells of aligning every pair i < j
+def _pair_cells(lengths):
+    total = int(lengths.sum() + len(lengths))
+    return (total * total - int(((lengths + 1) ** 2).sum())) // 2
+
+
+# current resident set size in bytes
+def rss_bytes():
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        # no procfs: peak RSS instead, in KiB on Linux and bytes on macOS
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return rss if sys.platform == "darwin" else rss * 1024
+
+
+# the phases of one sequence set as name -> (function, DP cells or None, setup or None),
+# the guide tree phase includes its k-mer distances
+#
+# setup runs before a phase is timed: the alignment sp_score and sp_delta need is only made
+# when one of them is run, and reused from the msa phase if it ran first
+#
+# sp_delta is the score change of every row of the alignment shifted one column to the
+# right, each found by SPScorer from the columns it changes instead of by rescoring
+def _phases(X, workers):
+    lengths = X.lengths()
+    n = len(X)
+    msa = MultipleAlignment(distance="kmer", workers=workers)
+    made = []
+
+    def align():
+        alignment = msa.computeMultipleAlignment(X)
+        made[:] = [alignment]
+        return alignment
+
+    def aligned():
+        return made[0] if made else align()
+
+    scorer = []
+
+    def score_rows():
+        scorer[:] = [SPScorer(aligned(), substitution.table(Alignment.d).scores)]
+
+    def deltas():
+        rows = scorer[0].rows
+        for r in range(rows.shape[0]):
+            scorer[0].delta_row(r, np.roll(rows[r], 1))
+
+    def pairwise():
+        a = Alignment(X[0], X[1])
+        a.compute_alignment()
+
+    def pairwise_banded():
+        a = Alignment(X[0], X[1])
+        a.compute_alignment_banded()
+
+    def matrix(kind):
+        pair_cache.shared.clear()
+        all_pairs.all_pairs(X, kind, workers)
+
+    phases = {}
+    if n > 1:
+        phases["pairwise"] = (pairwise, (int(lengths[0]) + 1) * (int(lengths[1]) + 1), None)
+        # cells of the full matrix, so its GCUPS compare with those of pairwise
+        phases["banded"] = (pairwise_banded, (int(lengths[0]) + 1) * (int(lengths[1]) + 1), None)
+        phases["score_matrix"] = (lambda: matrix("score"), _pair_cells(lengths), None)
+        phases["kimura"] = (lambda: matrix("kimura"), _pair_cells(lengths), None)
+        phases["guide_tree"] = (lambda: guide_tree.build(kmer_distance.kmer_distance(list(X))), None, None)
+        phases["msa"] = (align, None, None)
+    phases["sp_score"] = (lambda: msa.scoreMultipleAlignment(made[0]), None, aligned)
+    phases["sp_delta"] = (deltas, None, score_rows)
+    return phases
+
+
+# best wall time over repeat runs, then one traced run for memory
+def measure(fn, cells, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    tracemalloc.start()
+    try:
+        fn()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return {"seconds": best,
+            "cells": cells,
+            "gcups": cells / best / 1e9 if cells and best > 0 else None,
+            "peak_bytes": peak,
+            "rss_bytes": rss_bytes()}
+
+
+# runs the phases on every set, named like "multiple32" or "synthetic16x500"
+def run(sets, synthetic, phases, repeat=3, workers=1, log=print):
+    inputs = [("multiple%d" % k, lambda k=k: SequenceStore.from_file("./sequences/multiple%d.txt" % k))
+              for k in sets]
+    inputs += [("synthetic%dx%d" % (n, length),
+                lambda n=n, length=length: SequenceStore.from_strings(synthetic_family(n, length)))
+               for n, length in synthetic]
+    results = []
+    for name, load in inputs:
+        X = load()
+        for phase, (fn, cells, setup) in _phases(X, workers).items():
+            if phase not in phases:
+                continue
+            if setup is not None:
+                setup()
+            result = {"set": name, "phase": phase, "sequences": len(X)}
+            result.update(measure(fn, cells, repeat))
+            log("%-18s %-13s %9.4fs %s %8.1f MiB" % (
+                name, phase, result["seconds"],
+                "%8.4f GCUPS" % result["gcups"] if result["gcups"] is not None else " " * 14,
+                result["peak_bytes"] / 2 ** 20))
+            results.append(result)
+    return {"meta": {"python": platform.python_version(), "numpy": np.__version__,
+                     "machine": platform.machine(), "cpus": os.cpu_count(), "workers": workers,
+                     "repeat": repeat, "time": time.strftime("%Y-%m-%dT%H:%M:%S")},
+            "results": results}
+
+
+# phases of current that are slower (or use more memory) than in baseline by more
+# than threshold, as a list of messages
+def regressions(current, baseline, threshold):
+    old = {(r["set"], r["phase"]): r for r in baseline["results"]}
+    found = []
+    for r in current["results"]:
+        before = old.get((r["set"], r["phase"]))
+        if before is None:
+            continue
+        if max(r["seconds"], before["seconds"]) >= MIN_SECONDS and \
+                r["seconds"] > before["seconds"] * (1 + threshold):
+            found.append("%s %s: %.4fs -> %.4fs" % (r["set"], r["phase"], before["seconds"], r["seconds"]))
+        if r["peak_bytes"] > before["peak_bytes"] * (1 + threshold) and \
+                r["peak_bytes"] - before["peak_bytes"] > 2 ** 20:
+            found.append("%s %s: peak %d -> %d bytes" % (r["set"], r["phase"], before["peak_bytes"],
+                                                         r["peak_bytes"]))
+    return found
+
+
+def _ints(text):
+    return [int(k) for k in text.split(",") if k]
+
+
+def _families(text):
+    return [tuple(int(v) for v in item.split("x")) for item in text.split(",") if item]
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Benchmark the alignment engines")
+    parser.add_argument("--sets", type=_ints, default=SETS,
+                        help="bundled sets to run, e.g. 3,10,32 (default: all)")
+    parser.add_argument("--synthetic", type=_families, default=SYNTHETIC,
+                        help="synthetic families as SEQUENCESxLENGTH, e.g. 16x500,8x2000")
+    parser.add_argument("--phases", type=lambda s: s.split(","), default=PHASES,
+                        help="phases to run (default: " + ",".join(PHASES) + ")")
+    parser.add_argument("--repeat", type=int, default=3, help="timed runs per phase, the best is kept")
+    parser.add_argument("--workers", type=int, default=1, help="processes for the parallel phases")
+    parser.add_argument("--output", help="write the results to this JSON file")
+    parser.add_argument("--compare", help="baseline JSON file to check the results against")
+    parser.add_argument("--threshold", type=float, default=0.2,
+                        help="allowed slowdown before a phase counts as regressed (default 0.2)")
+    args = parser.parse_args(argv)
+
+    unknown = set(args.phases) - set(PHASES)
+    if unknown:
+        parser.error("unknown phases: " + ", ".join(sorted(unknown)))
+    results = run(args.sets, args.synthetic, args.phases, args.repeat, args.workers)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=1)
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        found = regressions(results, baseline, args.threshold)
+        for message in found:
+            print("REGRESSION " + message)
+        if found:
+            return 1
+        print("no regressions past %d%%" % round(args.threshold * 100))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,108 @@
+import numpy as np
+
+from substitution import GAP, encode, decode
+import dp_scores
+import substitution
+
+"""
+NumPy fill engine for Needleman-Wunsch alignment.
+
+Sequences are encoded as integer arrays and scores come from the code-indexed
+table in substitution, so a whole row of F can be computed with a handful of array
+operations instead of one Python call per cell.
+"""
+
+# direction bits stored in P, 1 = gap in Y (top), 2 = gap in X (left), 4 = no gap (diag)
+TOP = 1
+LEFT = 2
+DIAG = 4
+
+
+# fills one row of F given the row above it
+#
+# prev is the previous row, first is the value of the new row's first cell,
+# diag holds the substitution scores for every remaining cell, top is the
+# score for a gap in Y and left the score(s) for a gap in X
+#
+# the left dependency is resolved with a running maximum: with G the running
+# sum of left gap scores, F[j] - G[j] = max(cand[j] - G[j], F[j-1] - G[j-1])
+#
+# returns the new row and the direction bits of every cell in it
+def fill_row(prev, first, diag, top, left):
+    diag = prev[:-1] + diag
+    top = prev[1:] + top
+    cand = np.maximum(diag, top)
+
+    g = np.empty(len(prev), dtype=np.int64)
+    g[0] = 0
+    g[1:] = left
+    np.cumsum(g, out=g)
+
+    row = np.empty(len(prev), dtype=np.int64)
+    row[0] = first
+    row[1:] = cand - g[1:]
+    np.maximum.accumulate(row, out=row)
+    row += g
+
+    bits = np.zeros(len(prev), dtype=np.uint8)
+    cur = row[1:]
+    bits[1:] = (cur == top) * TOP + (cur == row[:-1] + left) * LEFT + (cur == diag) * DIAG
+    return row, bits
+
+
+# resolves direction bits into a single move, preferring diag > left > top
+# exactly like the pure Python fill in Alignment.compute_alignment_reference
+def pairwise_move(bits):
+    if bits & DIAG:
+        return DIAG
+    if bits & LEFT:
+        return LEFT
+    return TOP
+
+
+# follows P back from (n, m) and returns the list of moves from start to end
+def traceback(p, move=pairwise_move):
+    i = p.shape[0] - 1
+    j = p.shape[1] - 1
+    ops = []
+    while i + j > 0:
+        op = move(p[i, j])
+        ops.append(op)
+        if op != LEFT:
+            i -= 1
+        if op != TOP:
+            j -= 1
+    ops.reverse()
+    return np.array(ops, dtype=np.uint8)
+
+
+# builds the gapped versions of x and y from a list of moves
+def apply_moves(x, y, ops):
+    xa = np.full(len(ops), GAP, dtype=np.uint8)
+    ya = np.full(len(ops), GAP, dtype=np.uint8)
+    xa[ops != LEFT] = x
+    ya[ops != TOP] = y
+    return xa, ya
+
+
+# aligns sequences x and y (strings or encoded), returns the score and both gapped strings
+#
+# the moves are kept packed at 2 bits a cell and F one row at a time (see traceback_store.py);
+# with workers other than 1, a large enough matrix is filled by the tiled wavefront on a
+# process pool instead (None: all CPUs), see wavefront.py
+def align(x, y, d, workers=1):
+    table = substitution.table(d).residues
+    xc = encode(x)
+    yc = encode(y)
+    scores = dp_scores.PairScores(xc, yc, table, d)
+    # both modules import this one
+    if workers != 1:
+        import wavefront
+        score, p = wavefront.fill(scores, workers)
+        ops = traceback(p)
+    else:
+        import traceback_store
+        score, moves = traceback_store.fill_packed(scores, traceback_store.PAIRWISE)
+        ops = moves.traceback()
+    xa, ya = apply_moves(xc, yc, ops)
+    return score, decode(xa), decode(ya)
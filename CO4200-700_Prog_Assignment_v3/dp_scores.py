@@ -0,0 +1,64 @@
+import numpy as np
+
+import instrumentation
+from substitution import GAP
+
+"""
+Scores of one Needleman-Wunsch DP matrix, for the fills that work on it in
+pieces (wavefront tiles, packed and checkpointed tracebacks).
+
+Both kinds give the gap scores of every row (top) and column (left), row 0
+and column 0 of F, and the diagonal scores of any rectangle of cells, so a
+fill can start anywhere it knows the F values above and to the left.
+Each kind also names the counters its fills add their cells and bytes to.
+"""
+
+
+# adds the cells a fill of scores computed and the bytes it held to the counters of
+# its kind; callers check instrumentation.enabled first
+def count_fill(scores, cells, nbytes):
+    instrumentation.count(scores.counters[0], cells)
+    instrumentation.count(scores.counters[1], nbytes)
+
+
+# scores of aligning encoded sequences x and y with linear gap penalty d
+class PairScores(object):
+    __slots__ = ("x", "y", "table", "top", "left", "first_row", "first_col")
+    counters = ("dp_cells", "dp_bytes")
+
+    def __init__(self, x, y, table, d):
+        self.x = x
+        self.y = y
+        self.table = table
+        self.top = np.full(len(x), -d, dtype=np.int64) # gap in y, per row
+        self.left = np.full(len(y), -d, dtype=np.int64) # gap in x, per column
+        self.first_row = -d * np.arange(len(y) + 1)
+        self.first_col = -d * np.arange(len(x) + 1)
+
+    # substitution scores of the cells in rows r0 .. r1 - 1 and columns c0 .. c1 - 1 of F
+    def diag(self, r0, r1, c0, c1):
+        return self.table[self.x[r0 - 1:r1 - 1, None], self.y[None, c0 - 1:c1 - 1]]
+
+    # scores of the cells in row i and columns 1 .. width - 1
+    def diag_row(self, i, width):
+        return self.table[self.x[i - 1], self.y[:width - 1]]
+
+
+# scores of aligning two profiles given their column counts and sizes
+class ProfileScores(object):
+    __slots__ = ("weighted", "cY", "top", "left", "first_row", "first_col")
+    counters = ("profile_cells", "profile_bytes")
+
+    def __init__(self, cX, nX, cY, nY, table):
+        self.weighted = cX @ table
+        self.cY = cY
+        self.top = (cX @ table[:, GAP]) * nY
+        self.left = (cY @ table[:, GAP]) * nX
+        self.first_row = np.concatenate(([0], np.cumsum(self.left)))
+        self.first_col = np.concatenate(([0], np.cumsum(self.top)))
+
+    def diag(self, r0, r1, c0, c1):
+        return self.weighted[r0 - 1:r1 - 1] @ self.cY[c0 - 1:c1 - 1].T
+
+    def diag_row(self, i, width):
+        return self.cY[:width - 1] @ self.weighted[i - 1]
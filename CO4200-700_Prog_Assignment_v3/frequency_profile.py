@@ -0,0 +1,123 @@
+import numpy as np
+
+import banded
+import dp_engine
+import dp_scores
+import substitution
+import traceback_store
+from dp_engine import DIAG, LEFT, TOP
+from substitution import GAP, SIZE
+
+"""
+Frequency-profile engine for MultipleAlignment.computeProfileAlignment.
+
+A profile is stored as one count vector per column (how many of each residue
+and how many gaps), so the sum-of-pairs score of column i of X against column j
+of Y is counts_X[i] . S . counts_Y[j]. All of these come from one matrix
+product, and the cost of a DP cell no longer depends on the profile sizes.
+"""
+
+# per-column residue and gap counts of an encoded profile, one row per column
+def column_counts(codes):
+    n = codes.shape[1]
+    index = np.arange(n) * SIZE + codes
+    return np.bincount(index.ravel(), minlength=n * SIZE).reshape(n, SIZE)
+
+
+# resolves direction bits the way the profile traceback does: a gap in X is
+# preferred, then a gap in Y, then no gap
+def profile_move(bits):
+    if bits & LEFT:
+        return LEFT
+    if bits & TOP:
+        return TOP
+    return DIAG
+
+
+# traceback moves of aligning two profiles given their column counts and sizes
+#
+# the moves are kept packed at 2 bits a cell and F one row at a time (see traceback_store.py);
+# with workers other than 1, a large enough matrix is filled by the tiled wavefront on a
+# process pool instead (None: all CPUs)
+def alignment_moves(cX, nX, cY, nY, table, workers=1):
+    scores = dp_scores.ProfileScores(cX, nX, cY, nY, table)
+    if workers != 1:
+        import wavefront # imports dp_engine, which this module needs first
+        return dp_engine.traceback(wavefront.fill(scores, workers)[1], move=profile_move)
+    return traceback_store.fill_packed(scores, traceback_store.PROFILE)[1].traceback()
+
+
+# gapped rows of a profile after applying the moves of a traceback,
+# side is TOP for the X profile and LEFT for the Y profile
+def apply_moves(codes, ops, side):
+    other = LEFT if side == TOP else TOP
+    out = np.full((codes.shape[0], len(ops)), GAP, dtype=np.uint8)
+    out[:, ops != other] = codes
+    return out
+
+
+# gapped rows of both profiles as strings, rows of X followed by rows of Y
+def _rows(xcodes, ycodes, ops):
+    rows = np.vstack((apply_moves(xcodes, ops, TOP), apply_moves(ycodes, ops, LEFT)))
+    return [substitution.decode(row) for row in rows]
+
+
+# optimal alignment of profile X to profile Y, returned as an array of strings,
+# rows of X followed by rows of Y; workers as for alignment_moves
+def align(X, Y, d, workers=1):
+    table = substitution.table(d).scores
+    xcodes = substitution.encode_rows(X)
+    ycodes = substitution.encode_rows(Y)
+    ops = alignment_moves(column_counts(xcodes), len(X), column_counts(ycodes), len(Y), table, workers)
+    return _rows(xcodes, ycodes, ops)
+
+
+# align keeping only every k-th row of F and refilling blocks during the traceback,
+# for profiles too long for even a packed traceback (see traceback_store.py)
+def align_checkpointed(X, Y, d, k=None):
+    table = substitution.table(d).scores
+    xcodes = substitution.encode_rows(X)
+    ycodes = substitution.encode_rows(Y)
+    scores = dp_scores.ProfileScores(column_counts(xcodes), len(X), column_counts(ycodes), len(Y), table)
+    _, ops = traceback_store.align_checkpointed(scores, traceback_store.PROFILE, k)
+    return _rows(xcodes, ycodes, ops)
+
+
+# align through anchors shared by the consensus sequences of X and Y, the profile DP
+# only filling the rectangles between them (see anchored.py); k is the k-mer length
+def align_anchored(X, Y, d, k=None):
+    import anchored # imports this module first
+    table = substitution.table(d).scores
+    xcodes = substitution.encode_rows(X)
+    ycodes = substitution.encode_rows(Y)
+    ops = anchored.alignment_moves(column_counts(xcodes), len(X), column_counts(ycodes), len(Y), table,
+                                   anchored.K if k is None else k)
+    return _rows(xcodes, ycodes, ops)
+
+
+# most frequent code of every column, used to find shared k-mers between profiles
+def consensus(counts):
+    return np.argmax(counts, axis=1).astype(np.uint8)
+
+
+# banded version of align, see banded.py; width fixes the band instead of choosing
+# it from k-mer hits between the two consensus sequences
+def align_banded(X, Y, d, width=None):
+    table = substitution.table(d).scores
+    xcodes = substitution.encode_rows(X)
+    ycodes = substitution.encode_rows(Y)
+    n = xcodes.shape[1]
+    m = ycodes.shape[1]
+    cX = column_counts(xcodes)
+    cY = column_counts(ycodes)
+    nX = len(X)
+    nY = len(Y)
+    if width is None:
+        limits = banded.band_limits(consensus(cX), consensus(cY))
+    else:
+        limits = banded.fixed_limits(n, m, width)
+    # only the cells inside the band are scored, column against column
+    scores = dp_scores.ProfileScores(cX, nX, cY, nY, table)
+    full = lambda: (None, traceback_store.fill_packed(scores, traceback_store.PROFILE)[1].traceback())
+    score, ops = banded.align(scores, limits, profile_move, full)
+    return _rows(xcodes, ycodes, ops)
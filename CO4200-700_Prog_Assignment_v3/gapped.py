@@ -0,0 +1,132 @@
+import numpy as np
+
+import anchored
+import frequency_profile
+import substitution
+from dp_engine import LEFT, TOP
+from frequency_profile import column_counts
+from substitution import GAP, SIZE
+
+"""
+Gap-index representation of profiles for progressive alignment.
+
+A profile is either a block of rows given as codes (a leaf) or the merge of
+two profiles. A merge stores no rows: it keeps its two children and, for each
+side, the gap events the merge inserted into every row of that child, as runs
+of (start, length) in the merged columns. Merging two profiles therefore only
+adds two event lists and the merged column counts, O(columns * alphabet),
+however many rows the profiles hold. The gapped rows are built once, when the
+final profile is turned into strings, by composing the column maps from the
+root down to every leaf.
+"""
+
+
+# runs of True in a boolean array as an array of (start, length) rows
+def runs(mask):
+    edges = np.diff(np.concatenate(([0], mask.view(np.int8), [0])))
+    starts = np.flatnonzero(edges == 1)
+    ends = np.flatnonzero(edges == -1)
+    return np.column_stack((starts, ends - starts)).astype(np.int64)
+
+
+# columns of the merged profile that hold a child's columns, given the gap runs
+# inserted into that child and the merged length
+def column_map(events, length):
+    keep = np.ones(length, dtype=bool)
+    for start, run in events:
+        keep[start:start + run] = False
+    return np.flatnonzero(keep)
+
+
+class GappedProfile(object):
+    __slots__ = ("codes", "counts", "size", "length", "children", "events")
+
+    # use from_rows or merge, codes is a 2D array of codes for a leaf and None for a merge
+    def __init__(self, codes, counts, size, length, children=None, events=None):
+        self.codes = codes
+        self.counts = counts
+        self.size = size
+        self.length = length
+        self.children = children
+        self.events = events
+
+    # leaf profile from rows of equal length (strings or codes)
+    @staticmethod
+    def from_rows(rows):
+        codes = substitution.encode_rows(rows)
+        return GappedProfile(codes, column_counts(codes), codes.shape[0], codes.shape[1])
+
+    # profile of X and Y aligned by the moves of a profile traceback, rows of X
+    # before rows of Y
+    @staticmethod
+    def merge(X, Y, ops):
+        length = len(ops)
+        xgaps = ops == LEFT
+        ygaps = ops == TOP
+        counts = np.zeros((length, SIZE), dtype=np.int64)
+        counts[~xgaps] += X.counts
+        counts[~ygaps] += Y.counts
+        counts[xgaps, GAP] += X.size
+        counts[ygaps, GAP] += Y.size
+        # the children's counts are not needed again, so they are not kept in the tree
+        children = (X._structure(), Y._structure())
+        return GappedProfile(None, counts, X.size + Y.size, length, children, (runs(xgaps), runs(ygaps)))
+
+    def _structure(self):
+        return GappedProfile(self.codes, None, self.size, self.length, self.children, self.events)
+
+    def __len__(self):
+        return self.size
+
+    # every leaf block with the columns of the final rows its columns go to, in row order
+    def _leaves(self):
+        stack = [(self, np.arange(self.length))]
+        while stack:
+            node, columns = stack.pop()
+            if node.children is None:
+                yield node.codes, columns
+                continue
+            X, Y = node.children
+            # Y goes on the stack first so X's rows come out first
+            stack.append((Y, columns[column_map(node.events[1], node.length)]))
+            stack.append((X, columns[column_map(node.events[0], node.length)]))
+
+    # the gapped rows as a 2D array of codes
+    def rows(self):
+        out = np.full((self.size, self.length), GAP, dtype=np.uint8)
+        r = 0
+        for codes, columns in self._leaves():
+            out[r:r + codes.shape[0], columns] = codes
+            r += codes.shape[0]
+        return out
+
+    # the gapped rows as strings
+    def strings(self):
+        return [substitution.decode(row) for row in self.rows()]
+
+    # gap runs of every row as (start, length) arrays in the final columns
+    def gap_runs(self):
+        return [runs(row == GAP) for row in self.rows()]
+
+
+# profile for a GappedProfile, a single sequence or an array of aligned rows
+def profile(X):
+    if isinstance(X, GappedProfile):
+        return X
+    if substitution.is_sequence(X):
+        X = [X]
+    return GappedProfile.from_rows(X)
+
+
+# optimal alignment of profile X to profile Y (anything profile() takes) as a
+# GappedProfile, the same alignment frequency_profile.align returns as strings;
+# with anchors=True, the alignment through anchors frequency_profile.align_anchored returns
+def align(X, Y, d, workers=1, anchors=False):
+    X = profile(X)
+    Y = profile(Y)
+    table = substitution.table(d).scores
+    if anchors:
+        ops = anchored.alignment_moves(X.counts, X.size, Y.counts, Y.size, table)
+    else:
+        ops = frequency_profile.alignment_moves(X.counts, X.size, Y.counts, Y.size, table, workers)
+    return GappedProfile.merge(X, Y, ops)
@@ -0,0 +1,176 @@
+import numpy as np
+
+"""
+Guide trees for progressive alignment, without scikit-learn.
+
+Distances are kept as a condensed float32 vector (the upper triangle of the
+square matrix, row by row). UPGMA ("average") and complete linkage use the
+nearest-neighbour chain algorithm, O(N^2) time, which is what
+AgglomerativeClustering ends up running through scipy. Complete-linkage trees
+(and their children_ numbering) are the same; UPGMA averages are stored in
+float32, so near-ties can merge in a different order than sklearn's float64
+run. Neighbor joining is the classic
+algorithm: each of the N - 3 joins scans all remaining pairs, so it is
+O(N^3) overall, vectorised over the pairs of each step.
+"""
+
+UPGMA = "average"
+COMPLETE = "complete"
+NJ = "nj"
+
+
+class GuideTree(object):
+    __slots__ = ("children_", "distances_", "n_leaves_", "method")
+
+    # children_ has one row per merge like AgglomerativeClustering: merge k joins
+    # nodes children_[k][0] and children_[k][1] into node n_leaves_ + k
+    def __init__(self, children, distances, n_leaves, method):
+        self.children_ = children
+        self.distances_ = distances
+        self.n_leaves_ = n_leaves
+        self.method = method
+
+
+# position of pair (i, j), i != j, in a condensed distance vector over n items
+def condensed_index(n, i, j):
+    a = np.minimum(i, j)
+    b = np.maximum(i, j)
+    return n * a - a * (a + 1) // 2 + (b - a - 1)
+
+
+# condensed float32 distances from a square matrix (list of lists or array),
+# a 1D input is taken to be condensed already
+def condensed(D):
+    D = np.asarray(D)
+    if D.ndim == 1:
+        return D.astype(np.float32)
+    i, j = np.triu_indices(D.shape[0], k=1)
+    return D[i, j].astype(np.float32)
+
+
+def _items(size):
+    # n from the length n * (n - 1) / 2 of a condensed vector
+    return int(round((1 + (1 + 8 * size) ** 0.5) / 2))
+
+
+# relabels merges of original cluster ids (the lower id keeps the merged cluster)
+# into AgglomerativeClustering numbering, as scipy does after sorting by height
+def _label(pairs, n):
+    parent = list(range(2 * n - 1))
+
+    def find(x):
+        while parent[x] != x:
+            parent[x] = parent[parent[x]]
+            x = parent[x]
+        return x
+
+    children = np.empty((len(pairs), 2), dtype=np.int64)
+    for k, (x, y) in enumerate(pairs):
+        a = find(x)
+        b = find(y)
+        children[k] = (a, b) if a < b else (b, a)
+        parent[a] = parent[b] = n + k
+    return children
+
+
+# UPGMA or complete linkage by the nearest-neighbour chain algorithm
+def _linkage(dist, n, method):
+    dist = dist.copy()
+    size = np.ones(n, dtype=np.int64)
+    pairs = []
+    heights = []
+    chain = []
+    everyone = np.arange(n)
+    for _ in range(n - 1):
+        if not chain:
+            chain.append(int(np.argmax(size > 0)))
+        while True:
+            x = chain[-1]
+            if len(chain) > 1:
+                y = chain[-2]
+                current = dist[condensed_index(n, x, y)]
+            else:
+                y = -1
+                current = np.inf
+            # nearest active cluster to x, ties keep the earlier candidate like scipy
+            others = everyone[(size > 0) & (everyone != x)]
+            d = dist[condensed_index(n, x, others)]
+            k = int(np.argmin(d))
+            if d[k] < current:
+                current = d[k]
+                y = int(others[k])
+            if len(chain) > 1 and y == chain[-2]:
+                break
+            chain.append(y)
+        chain.pop()
+        chain.pop()
+        if x > y:
+            x, y = y, x
+        nx = size[x]
+        ny = size[y]
+        pairs.append((x, y))
+        heights.append(float(current))
+        size[x] = 0
+        size[y] = nx + ny
+        # Lance-Williams update of the merged cluster (kept in slot y)
+        others = everyone[(size > 0) & (everyone != y)]
+        ix = condensed_index(n, others, x)
+        iy = condensed_index(n, others, y)
+        if method == COMPLETE:
+            dist[iy] = np.maximum(dist[ix], dist[iy])
+        else:
+            dist[iy] = (nx * dist[ix].astype(np.float64) + ny * dist[iy].astype(np.float64)) / (nx + ny)
+    order = np.argsort(np.array(heights), kind='mergesort')
+    pairs = [pairs[k] for k in order]
+    return _label(pairs, n), np.array(heights)[order]
+
+
+# neighbor joining, rooted at the last join
+def _neighbor_joining(dist, n):
+    D = np.zeros((n, n), dtype=np.float64)
+    i, j = np.triu_indices(n, k=1)
+    D[i, j] = dist
+    D[j, i] = dist
+    active = list(range(n))
+    node = list(range(n)) # tree node held by each row of D
+    children = []
+    heights = []
+    while len(active) > 2:
+        m = len(active)
+        sub = D[np.ix_(active, active)]
+        r = sub.sum(axis=1)
+        Q = (m - 2) * sub - r[:, None] - r[None, :]
+        np.fill_diagonal(Q, np.inf)
+        a, b = np.unravel_index(int(np.argmin(Q)), Q.shape)
+        if a > b:
+            a, b = b, a
+        ra = active[a]
+        rb = active[b]
+        children.append((node[ra], node[rb]))
+        heights.append(sub[a, b])
+        # the joined node takes row ra, distances to it follow the NJ reduction
+        new = 0.5 * (D[ra] + D[rb] - D[ra, rb])
+        D[ra] = new
+        D[:, ra] = new
+        D[ra, ra] = 0
+        node[ra] = n + len(children) - 1
+        active.pop(b)
+    children.append((node[active[0]], node[active[1]]))
+    heights.append(D[active[0], active[1]])
+    return np.array(children, dtype=np.int64), np.array(heights)
+
+
+# guide tree for a distance matrix (square or condensed), method is "average"
+# (UPGMA), "complete" or "nj"
+def build(D, method=COMPLETE):
+    dist = condensed(D)
+    n = _items(len(dist))
+    if n < 2:
+        return GuideTree(np.empty((0, 2), dtype=np.int64), np.empty(0), n, method)
+    if method in (UPGMA, COMPLETE):
+        children, heights = _linkage(dist, n, method)
+    elif method == NJ:
+        children, heights = _neighbor_joining(dist, n)
+    else:
+        raise ValueError("unknown guide tree method " + repr(method))
+    return GuideTree(children, heights, n, method)
@@ -0,0 +1,86 @@
+import numpy as np
+
+import frequency_profile
+import kmer_distance
+import substitution
+from dp_engine import DIAG, LEFT, TOP
+from frequency_profile import column_counts
+from substitution import GAP
+
+"""
+Adding sequences to an existing multiple alignment without rebuilding it.
+
+The existing rows stay as they are and are reduced once to the column counts
+of their frequency profile. Each new sequence is aligned to that profile on
+its own, an O(L^2) profile DP, which places every residue either on an
+existing column or in an insertion before one. All insertions are then merged
+in one pass: the insertion block before a column is as wide as the longest
+insertion any new sequence makes there, the existing rows get gaps across it
+and each new sequence's inserted residues are left-justified in it.
+
+Each new row is put below its nearest existing member by k-mer distance, so
+related sequences stay together.
+"""
+
+
+# index of the nearest existing row (ungapped) for every new sequence, by k-mer distance
+def nearest(rows, new):
+    members = [row[row != GAP] for row in rows]
+    return np.argmin(kmer_distance.kmer_distance_between(new, members), axis=1)
+
+
+# moves aligning sequence y to a profile given by its column counts and row count
+def _moves(counts, size, y, table):
+    return frequency_profile.alignment_moves(counts, size, column_counts(y[None, :]), 1, table)
+
+
+# aligns every new sequence to the profile of rows and merges the results
+#
+# returns the merged rows as a 2D array of codes (the existing rows in their
+# order, each followed by the new rows placed next to it) and, for every row
+# of the result, the index of the new sequence it holds or -1 for an old row
+def add(rows, new, d):
+    rows = substitution.encode_rows(rows)
+    new = [substitution.encode(y) for y in new]
+    table = substitution.table(d).scores
+    n, length = rows.shape
+    counts = column_counts(rows)
+    moves = [_moves(counts, n, y, table) for y in new]
+
+    # widest insertion before every existing column (and after the last one)
+    width = np.zeros(length + 1, dtype=np.int64)
+    for ops in moves:
+        before = np.cumsum(ops != LEFT) # existing columns used up to and including each move
+        inserted = np.bincount(before[ops == LEFT], minlength=length + 1)
+        np.maximum(width, inserted, out=width)
+    block = np.concatenate(([0], np.cumsum(width))) # insertion columns before block b
+    columns = np.arange(length) + block[1:length + 1] # final column of each existing column
+    total = length + int(width.sum())
+
+    out = np.full((n + len(new), total), GAP, dtype=np.uint8)
+    out[:n, columns] = rows
+    for k, (y, ops) in enumerate(zip(new, moves)):
+        before = np.cumsum(ops != LEFT)
+        placed = np.empty(len(ops), dtype=np.int64)
+        diag = ops == DIAG
+        placed[diag] = columns[before[diag] - 1]
+        left = np.flatnonzero(ops == LEFT)
+        if len(left):
+            # position of every inserted residue within its run
+            starts = np.concatenate(([True], np.diff(left) > 1))
+            run = np.maximum.accumulate(np.where(starts, np.arange(len(left)), 0))
+            b = before[left]
+            placed[left] = b + block[b] + (np.arange(len(left)) - run)
+        out[n + k, placed[ops != TOP]] = y
+
+    # new rows go below their nearest existing row
+    order = []
+    owner = nearest(rows, new) if new else []
+    below = [[] for _ in range(n)]
+    for k, r in enumerate(owner):
+        below[r].append(k)
+    for r in range(n):
+        order.append(r)
+        order.extend(n + k for k in below[r])
+    source = np.array([-1 if r < n else r - n for r in order], dtype=np.int64)
+    return out[order], source
@@ -0,0 +1,183 @@
+import json
+import time
+
+"""
+Timers, counters and an event stream for the alignment pipeline.
+
+Instrumentation is off by default. While it is off, count() and emit()
+return at once and span() hands back one shared do-nothing context manager,
+so the calls can stay in the hot paths; call sites that would build
+arguments first check the module's enabled flag.
+
+When on, every event is a dict with at least "event" and "time" that is
+passed to each observer (any callable). Spans emit one event when they end,
+with "seconds", and add to a per-name timer; counters are plain running
+totals. JsonLinesLog is an observer that writes one JSON object per line.
+
+Worker processes have their own copy of this state. Work run there through
+collect() brings back the events, counters and timers it recorded, and
+merge() passes them on in the calling process; other work done in workers is
+not seen.
+"""
+
+enabled = False
+
+_observers = []
+_counters = {}
+_timers = {}
+
+
+class _NullSpan(object):
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class _Span(object):
+    __slots__ = ("name", "fields", "start")
+
+    def __init__(self, name, fields):
+        self.name = name
+        self.fields = fields
+        self.start = None
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        seconds = time.perf_counter() - self.start
+        _timers[self.name] = _timers.get(self.name, 0.0) + seconds
+        emit(self.name, seconds=seconds, **self.fields)
+        return False
+
+
+# observer writing every event as one line of JSON to a file (path or open file)
+class JsonLinesLog(object):
+
+    def __init__(self, target):
+        self.owned = isinstance(target, str)
+        self.file = open(target, 'a') if self.owned else target
+
+    def __call__(self, event):
+        self.file.write(json.dumps(event, default=str) + "\n")
+        self.file.flush()
+
+    def close(self):
+        if self.owned:
+            self.file.close()
+
+
+# turns instrumentation on, with the given observers added
+def enable(*observers):
+    global enabled
+    _observers.extend(observers)
+    enabled = True
+
+
+# turns instrumentation off and drops the observers, counters and timers are kept
+def disable():
+    global enabled
+    enabled = False
+    del _observers[:]
+
+
+# turns instrumentation on with a JSON-lines log of every event at path, returns the log
+def log_to(path):
+    log = JsonLinesLog(path)
+    enable(log)
+    return log
+
+
+# emits the counters and timers so far as one "summary" event
+def summary():
+    emit("summary", counters=counters(), timers=timers())
+
+
+def add_observer(observer):
+    _observers.append(observer)
+
+
+def remove_observer(observer):
+    _observers.remove(observer)
+
+
+# adds n to counter name
+def count(name, n=1):
+    if not enabled:
+        return
+    _counters[name] = _counters.get(name, 0) + n
+
+
+# sends an event to every observer
+def emit(event, **fields):
+    if not enabled:
+        return
+    record = {"event": event, "time": time.time()}
+    record.update(fields)
+    for observer in _observers:
+        observer(record)
+
+
+# context manager timing a block, the fields go into its event
+def span(name, **fields):
+    if not enabled:
+        return _NULL_SPAN
+    return _Span(name, fields)
+
+
+def counters():
+    return dict(_counters)
+
+
+# total seconds spent in the spans of each name
+def timers():
+    return dict(_timers)
+
+
+def reset():
+    _counters.clear()
+    _timers.clear()
+
+
+# runs fn(*args) recording into fresh state, with instrumentation on if on (the flag of
+# the calling process, which a worker may not share), and returns fn's result and what
+# it recorded as (events, counters, timers) for merge; the state before is restored
+def collect(on, fn, *args):
+    global enabled
+    saved = enabled, list(_observers), counters(), timers()
+    events = []
+    enabled = on
+    _observers[:] = [events.append]
+    reset()
+    try:
+        result = fn(*args)
+        recorded = (events, counters(), timers())
+    finally:
+        enabled, _observers[:] = saved[0], saved[1]
+        reset()
+        _counters.update(saved[2])
+        _timers.update(saved[3])
+    return result, recorded
+
+
+# adds what collect recorded: its events go to every observer, its counters and timers
+# are added to these
+def merge(recorded):
+    if not enabled:
+        return
+    events, counted, timed = recorded
+    for name, n in counted.items():
+        _counters[name] = _counters.get(name, 0) + n
+    for name, seconds in timed.items():
+        _timers[name] = _timers.get(name, 0.0) + seconds
+    for record in events:
+        for observer in _observers:
+            observer(record)
@@ -0,0 +1,89 @@
+import numpy as np
+
+import substitution
+
+"""
+k-mer distance estimate for building the guide tree (MUSCLE stage 1 style).
+
+Every sequence is reduced once to a vector of k-mer counts over a compressed
+amino-acid alphabet, and the distance of two sequences is 1 - F where F is the
+fraction of k-mers they have in common:
+
+    F = sum_t min(c_x[t], c_y[t]) / (min(len(x), len(y)) - k + 1)
+
+Only the k-mers a sequence holds can be shared, so each sequence is compared
+against all others on just those columns of the count vectors, O(N^2 * L)
+for sequences of length L, with no alignment at all.
+"""
+
+K = 4 # k-mer length
+
+# Dayhoff's six groups of exchangeable residues, letters not listed share one extra group
+DAYHOFF_6 = ["AGPST", "C", "DENQ", "FWY", "HKR", "ILMV"]
+
+# most bytes of the temporary array one comparison step builds
+BLOCK_BYTES = 1 << 24
+
+
+# group number of every residue code, and the number of groups including the extra one
+def _groups(groups):
+    g = np.full(substitution.SIZE, len(groups), dtype=np.int64)
+    for k, letters in enumerate(groups):
+        for c in letters:
+            g[substitution.code(c)] = k
+    return g, len(groups) + 1
+
+
+# k-mer count vector of every sequence, one row per sequence
+def kmer_counts(SequenceList, k=K, groups=DAYHOFF_6):
+    lookup, size = _groups(groups)
+    counts = np.zeros((len(SequenceList), size ** k), dtype=np.int32)
+    lengths = np.zeros(len(SequenceList), dtype=np.int64)
+    i = 0
+    while i < len(SequenceList):
+        g = lookup[substitution.encode(SequenceList[i])]
+        lengths[i] = len(g)
+        n = len(g) - k + 1
+        if n > 0:
+            h = np.zeros(n, dtype=np.int64)
+            q = 0
+            while q < k:
+                h = h * size + g[q:q + n]
+                q += 1
+            counts[i] = np.bincount(h, minlength=size ** k)
+        i += 1
+    return counts, lengths
+
+
+# distances between every sequence of one set (counts and lengths as kmer_counts
+# gives them) and every sequence of another, as an array
+def _distances(countsA, lengthsA, countsB, lengthsB, k):
+    shared = np.zeros((len(countsA), len(countsB)), dtype=np.int64)
+    i = 0
+    while i < len(countsA):
+        present = np.flatnonzero(countsA[i])
+        mine = countsA[i, present]
+        # rows of B per step, so the len(present) columns taken from them stay under BLOCK_BYTES
+        step = max(1, BLOCK_BYTES // (countsB.itemsize * max(1, len(present))))
+        j = 0
+        while j < len(countsB):
+            shared[i, j:j + step] = np.minimum(countsB[j:j + step, present], mine).sum(axis=1)
+            j += step
+        i += 1
+    possible = np.minimum(lengthsA[:, None], lengthsB[None, :]) - k + 1
+    F = np.where(possible > 0, shared / np.maximum(possible, 1), 0.0)
+    return 1.0 - F
+
+
+# fraction of shared k-mers turned into a distance for every pair, returned as a
+# list of lists like MultipleAlignment.Kimuradistance
+def kmer_distance(SequenceList, k=K, groups=DAYHOFF_6):
+    counts, lengths = kmer_counts(SequenceList, k, groups)
+    return _distances(counts, lengths, counts, lengths, k).tolist()
+
+
+# k-mer distance of every sequence in A to every sequence in B, as a len(A) x len(B) array
+def kmer_distance_between(A, B, k=K, groups=DAYHOFF_6):
+    countsA, lengthsA = kmer_counts(A, k, groups)
+    countsB, lengthsB = kmer_counts(B, k, groups)
+    return _distances(countsA, lengthsA, countsB, lengthsB, k)
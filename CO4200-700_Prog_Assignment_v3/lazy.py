@@ -0,0 +1,25 @@
+import importlib.util
+import sys
+
+"""
+Deferred imports for modules that are slow to load.
+
+lazy_import returns a module object straight away but only runs the module's
+code on first attribute access, so scripts that never reach the alignment
+engines (or reach them late) do not pay for numpy at start-up.
+"""
+
+
+# the module called name, loaded on first use
+def lazy_import(name):
+    if name in sys.modules:
+        return sys.modules[name]
+    spec = importlib.util.find_spec(name)
+    if spec is None:
+        raise ImportError("no module named " + repr(name))
+    loader = importlib.util.LazyLoader(spec.loader)
+    spec.loader = loader
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    loader.exec_module(module)
+    return module
@@ -0,0 +1,238 @@
+import numpy as np
+
+import instrumentation
+from dp_engine import fill_row, pairwise_move, DIAG, LEFT, TOP
+
+"""
+Linear-memory modes for Needleman-Wunsch alignment.
+
+score_and_counts keeps only two rows of F, and hirschberg recovers the full
+alignment by divide and conquer. score_and_counts_many runs score_and_counts
+for one query against many targets at once, and scores_many gives only the
+scores, global or local (Smith-Waterman), of one query against many targets. Both follow the same pointer chain as the
+full-matrix traceback, so scores, identity counts and gapped strings are the
+same as compute_alignment gives.
+"""
+
+# regions with at most this many cells are filled in full and traced back directly
+BASE_CELLS = 4096
+
+
+# resolves a row of direction bits into single moves (diag > left > top)
+def _moves(bits):
+    return np.where(bits & DIAG, DIAG, np.where(bits & LEFT, LEFT, TOP))
+
+
+# carries a per-cell value along the pointer chain of one row: diag cells take
+# the value from up-left, top cells from above, and left cells copy the
+# nearest non-left cell to their left
+def _follow(moves, prev, base_diag, first):
+    w = len(moves)
+    cur = np.empty(w, dtype=prev.dtype)
+    cur[0] = first
+    cur[1:] = np.where(moves[1:] == DIAG, prev[:-1] + base_diag, prev[1:])
+    src = np.where(moves != LEFT, np.arange(w), 0)
+    np.maximum.accumulate(src, out=src)
+    return cur[src]
+
+
+# score of the optimal alignment of encoded x and y using two rows of F
+#
+# also returns the number of exact matches and of positions with no gap along
+# the alignment the traceback would pick, which is all the Kimura distance needs
+def score_and_counts(x, y, table, d):
+    m = len(y)
+    if instrumentation.enabled:
+        instrumentation.count("dp_cells", (len(x) + 1) * (m + 1))
+    f = -d * np.arange(m + 1)
+    matches = np.zeros(m + 1, dtype=np.int64)
+    scored = np.zeros(m + 1, dtype=np.int64)
+    i = 1
+    while i <= len(x):
+        f, bits = fill_row(f, -i * d, table[x[i - 1], y], -d, -d)
+        moves = _moves(bits)
+        moves[0] = TOP
+        matches = _follow(moves, matches, y == x[i - 1], 0)
+        scored = _follow(moves, scored, 1, 0)
+        i += 1
+    return int(f[-1]), int(matches[-1]), int(scored[-1])
+
+
+# score_and_counts of x against every sequence in ys, as three int64 arrays
+#
+# the targets are padded into one 2D array (one row per target) and every DP row
+# is filled for all of them with the same array operations, so each NumPy call
+# advances every alignment; cells past the end of a target never feed back into
+# its own cells, so the padding does not change any result
+def score_and_counts_many(x, ys, table, d):
+    lengths = np.array([len(y) for y in ys], dtype=np.int64)
+    t = len(ys)
+    if t == 0:
+        return lengths, lengths.copy(), lengths.copy()
+    m = int(lengths.max())
+    if instrumentation.enabled:
+        instrumentation.count("dp_cells", int((len(x) + 1) * (lengths + 1).sum()))
+        instrumentation.count("batched_targets", t)
+    y = np.zeros((t, m), dtype=np.uint8) # padded with code 0, any residue will do
+    for k in range(t):
+        y[k, :lengths[k]] = ys[k]
+
+    f = np.broadcast_to(-d * np.arange(m + 1), (t, m + 1)).copy()
+    g = -d * np.arange(m + 1) # running sum of left gap scores, the same for every column
+    matches = np.zeros((t, m + 1), dtype=np.int64)
+    scored = np.zeros((t, m + 1), dtype=np.int64)
+    columns = np.arange(m + 1)
+    i = 1
+    while i <= len(x):
+        # fill_row for all targets, with the running maximum taken along each row
+        diag = f[:, :-1] + table[x[i - 1], y]
+        top = f[:, 1:] - d
+        row = np.empty_like(f)
+        row[:, 0] = -i * d
+        row[:, 1:] = np.maximum(diag, top) - g[1:]
+        np.maximum.accumulate(row, axis=1, out=row)
+        row += g
+        cur = row[:, 1:]
+        # resolved moves (diag > left > top) and _follow for all targets
+        moves = np.full((t, m + 1), TOP, dtype=np.uint8)
+        moves[:, 1:] = np.where(cur == diag, DIAG, np.where(cur == row[:, :-1] - d, LEFT, TOP))
+        src = np.where(moves != LEFT, columns, 0)
+        np.maximum.accumulate(src, axis=1, out=src)
+        is_diag = moves[:, 1:] == DIAG
+        cur = np.empty_like(matches)
+        cur[:, 0] = 0
+        cur[:, 1:] = np.where(is_diag, matches[:, :-1] + (y == x[i - 1]), matches[:, 1:])
+        matches = np.take_along_axis(cur, src, axis=1)
+        cur[:, 1:] = np.where(is_diag, scored[:, :-1] + 1, scored[:, 1:])
+        scored = np.take_along_axis(cur, src, axis=1)
+        f = row
+        i += 1
+    k = np.arange(t)
+    return f[k, lengths], matches[k, lengths], scored[k, lengths]
+
+
+# optimal scores of x against every sequence in ys, as an int64 array, global
+# (Needleman-Wunsch) or with local=True the best local (Smith-Waterman) score
+#
+# the targets are padded as in score_and_counts_many; a local score is the
+# highest cell of F, which is only taken over each target's own columns
+def scores_many(x, ys, table, d, local=False):
+    lengths = np.array([len(y) for y in ys], dtype=np.int64)
+    t = len(ys)
+    if t == 0:
+        return lengths
+    m = int(lengths.max())
+    if instrumentation.enabled:
+        instrumentation.count("dp_cells", int((len(x) + 1) * (lengths + 1).sum()))
+        instrumentation.count("batched_targets", t)
+    y = np.zeros((t, m), dtype=np.uint8)
+    for k in range(t):
+        y[k, :lengths[k]] = ys[k]
+
+    g = -d * np.arange(m + 1)
+    if local:
+        f = np.zeros((t, m + 1), dtype=np.int64)
+        valid = np.arange(m + 1) <= lengths[:, None]
+        best = np.zeros(t, dtype=np.int64)
+    else:
+        f = np.broadcast_to(g, (t, m + 1)).copy()
+    i = 1
+    while i <= len(x):
+        row = np.empty_like(f)
+        row[:, 0] = 0 if local else -i * d
+        row[:, 1:] = np.maximum(f[:, :-1] + table[x[i - 1], y], f[:, 1:] - d)
+        if local:
+            # a local alignment may start at any cell, which the left chain keeps
+            np.maximum(row, 0, out=row)
+        row -= g
+        np.maximum.accumulate(row, axis=1, out=row)
+        row += g
+        if local:
+            np.maximum(best, np.where(valid, row, 0).max(axis=1), out=best)
+        f = row
+        i += 1
+    if local:
+        return best
+    return f[np.arange(t), lengths]
+
+
+# fills the rectangle of F below row top and right of column left, keeping only
+# the last row, every row's value in column col is collected when col is given
+def _fill_region(x, y, table, d, top, left, col=None):
+    f = top
+    collected = [top[col]] if col is not None else None
+    k = 1
+    while k < len(left):
+        f, bits = fill_row(f, left[k], table[x[k - 1], y], -d, -d)
+        if col is not None:
+            collected.append(f[col])
+        k += 1
+    return f, collected
+
+
+# traceback of a region small enough to keep its whole P matrix
+def _solve_direct(x, y, table, d, top, left):
+    n = len(x)
+    p = np.empty((n + 1, len(y) + 1), dtype=np.uint8)
+    p[0] = LEFT
+    p[:, 0] = TOP
+    f = top
+    k = 1
+    while k <= n:
+        f, bits = fill_row(f, left[k], table[x[k - 1], y], -d, -d)
+        p[k, 1:] = bits[1:]
+        k += 1
+    ops = []
+    i = n
+    j = len(y)
+    while i + j > 0:
+        op = pairwise_move(p[i, j])
+        ops.append(op)
+        if op != LEFT:
+            i -= 1
+        if op != TOP:
+            j -= 1
+    ops.reverse()
+    return ops
+
+
+# moves from the top left to the bottom right corner of a region, given the
+# values of F along its top row and left column
+#
+# the region is split at its middle row; a forward pass records, for every cell
+# below that row, the column at which its pointer chain first reaches it, so the
+# split column is exactly where the full traceback crosses the middle row
+def _solve(x, y, table, d, top, left):
+    n = len(x)
+    m = len(y)
+    if n <= 1 or (n + 1) * (m + 1) <= BASE_CELLS:
+        return _solve_direct(x, y, table, d, top, left)
+
+    mid = n // 2
+    row, _ = _fill_region(x[:mid], y, table, d, top, left[:mid + 1])
+
+    f = row
+    origin = np.arange(m + 1)
+    k = mid + 1
+    while k <= n:
+        f, bits = fill_row(f, left[k], table[x[k - 1], y], -d, -d)
+        moves = _moves(bits)
+        moves[0] = TOP
+        origin = _follow(moves, origin, 0, origin[0])
+        k += 1
+    c = int(origin[-1])
+
+    # F along column c below the middle row is the left edge of the lower half
+    _, lower_left = _fill_region(x[mid:], y[:c], table, d, row[:c + 1], left[mid:], col=c)
+
+    upper = _solve(x[:mid], y[:c], table, d, top[:c + 1], left[:mid + 1])
+    lower = _solve(x[mid:], y[c:], table, d, row[c:], np.array(lower_left))
+    return upper + lower
+
+
+# Hirschberg alignment of encoded x and y in O(n + m) memory, returns the list
+# of moves of the same alignment the full-matrix traceback produces
+def hirschberg(x, y, table, d):
+    top = -d * np.arange(len(y) + 1)
+    left = -d * np.arange(len(x) + 1)
+    return np.array(_solve(x, y, table, d, top, left), dtype=np.uint8)
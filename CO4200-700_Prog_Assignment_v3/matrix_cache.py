@@ -0,0 +1,218 @@
+import json
+import os
+import tempfile
+import time
+from contextlib import contextmanager
+
+import numpy as np
+
+import pair_cache
+
+try:
+    import fcntl
+except ImportError: # no flock (Windows): the cache still works, but only for one process at a time
+    fcntl = None
+
+"""
+Persistent on-disk cache of all-pairs results (score, exact matches and
+positions scored of every pair), so the score matrix and Kimura distances of
+a set can be rebuilt without aligning the pairs seen in earlier runs.
+
+The cache is a directory of blocks. A block is the result matrix of one
+earlier run, a (3, n, n) int64 .npy file, and the index (index.json) records
+for every block the scoring parameters, the content hash of each of its n
+sequences, its size and when it was last used. A lookup maps the hashes of
+the new set onto every block with the same parameters and reads the pairs
+found from a memory map of the block, so only pairs with a sequence that no
+block holds are aligned again. Two copies of one sequence share a hash, so
+their own pair is never read from a block. The matrix of the new set is then
+saved as a block and blocks whose sequences it covers are dropped. Past
+max_bytes, the least recently used blocks are evicted.
+
+Blocks are written to a temporary file and renamed into place, and the index
+is only changed under an exclusive flock on the lock file, so several
+processes can share one cache directory. Lookups read it under a shared
+flock and only take the exclusive one to refresh last-used times older than
+TOUCH seconds.
+"""
+
+DEFAULT_MAX_BYTES = 256 * 1024 * 1024
+
+# seconds the last-used time of a block may lag before a lookup rewrites the index
+TOUCH = 60
+
+# environment variables from_environment reads
+DIR_VARIABLE = "MSA_CACHE_DIR"
+MAX_BYTES_VARIABLE = "MSA_CACHE_MAX_BYTES"
+
+INDEX = "index.json"
+LOCK = "lock"
+
+FIELDS = 3 # score, matches, scored
+
+
+# cache parameters key, the same for every kind of matrix built from the same alignments
+def parameters(method, d):
+    return "%s|%s|%d" % (pair_cache.MATRIX, method, d)
+
+
+# hex content hash of every sequence, as pair_cache hashes them
+def hashes(sequences):
+    return [pair_cache.sequence_hash(seq).hex() for seq in sequences]
+
+
+class MatrixCache(object):
+
+    def __init__(self, root, max_bytes=DEFAULT_MAX_BYTES):
+        self.root = root
+        self.max_bytes = max_bytes
+        os.makedirs(os.path.join(root, "blocks"), exist_ok=True)
+
+    # holds the lock file, exclusive for changing the index and shared for reading it
+    @contextmanager
+    def _locked(self, exclusive):
+        with open(os.path.join(self.root, LOCK), 'a') as f:
+            if fcntl is not None:
+                fcntl.flock(f, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+            try:
+                yield
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(f, fcntl.LOCK_UN)
+
+    def _path(self, name):
+        return os.path.join(self.root, "blocks", name + ".npy")
+
+    def _read_index(self):
+        try:
+            with open(os.path.join(self.root, INDEX)) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _write_index(self, index):
+        fd, tmp = tempfile.mkstemp(dir=self.root, suffix=".tmp")
+        with os.fdopen(fd, 'w') as f:
+            json.dump(index, f)
+        os.replace(tmp, os.path.join(self.root, INDEX))
+
+    # results known for the pairs of a set, given the hashes of its sequences:
+    # a boolean (n, n) mask and a (3, n, n) array of score, matches and scored
+    #
+    # pairs of two sequences with the same hash are never known
+    def lookup(self, keys, params):
+        n = len(keys)
+        known = np.zeros((n, n), dtype=bool)
+        values = np.zeros((FIELDS, n, n), dtype=np.int64)
+        position = {}
+        for i, key in enumerate(keys):
+            position.setdefault(key, i)
+        now = time.time()
+        stale = []
+        with self._locked(False):
+            index = self._read_index()
+            # newest blocks first, they cover the most sequences
+            for name, block in sorted(index.items(), key=lambda item: -item[1]["used"]):
+                if block["params"] != params:
+                    continue
+                # first copy of every hash on both sides, so no cell of the grid is written twice
+                ours = {}
+                for k, key in enumerate(block["hashes"]):
+                    if key in position and key not in ours:
+                        ours[key] = k
+                if len(ours) < 2:
+                    continue
+                try:
+                    data = np.load(self._path(name), mmap_mode='r')
+                except (OSError, ValueError):
+                    continue
+                mine = np.array([position[key] for key in ours])
+                theirs = np.array(list(ours.values()))
+                grid = np.ix_(mine, mine)
+                new = ~known[grid]
+                values[(slice(None),) + grid] = np.where(new, data[(slice(None),) + np.ix_(theirs, theirs)],
+                                                         values[(slice(None),) + grid])
+                known[grid] = True
+                if now - block["used"] > TOUCH:
+                    stale.append(name)
+        # the diagonal of a block is a sequence against itself, not a result
+        np.fill_diagonal(known, False)
+        # pairs of a sequence that appears twice in the set only have the copy in position
+        for i, key in enumerate(keys):
+            j = position[key]
+            if j != i:
+                known[i] = known[j]
+                known[:, i] = known[:, j]
+                values[:, i] = values[:, j]
+                values[:, :, i] = values[:, :, j]
+        same = np.array([position[key] for key in keys])
+        known[same[:, None] == same[None, :]] = False
+        if stale:
+            self._touch(stale, now)
+        return known, values
+
+    # sets the last-used time of blocks still in the index
+    def _touch(self, names, now):
+        with self._locked(True):
+            index = self._read_index()
+            for name in names:
+                if name in index:
+                    index[name]["used"] = now
+            self._write_index(index)
+
+    # saves the (3, n, n) results of a set as a new block, drops the blocks it covers and
+    # evicts least recently used blocks past max_bytes
+    def store(self, keys, params, values):
+        values = np.ascontiguousarray(values, dtype=np.int64)
+        if values.nbytes > self.max_bytes:
+            return
+        fd, tmp = tempfile.mkstemp(dir=os.path.join(self.root, "blocks"), suffix=".tmp")
+        with os.fdopen(fd, 'wb') as f:
+            np.save(f, values)
+        name = os.path.basename(tmp)[:-len(".tmp")]
+        os.replace(tmp, self._path(name))
+        covered = set(keys)
+        with self._locked(True):
+            index = self._read_index()
+            for old in list(index):
+                if index[old]["params"] == params and covered.issuperset(index[old]["hashes"]):
+                    self._remove(index, old)
+            index[name] = {"params": params, "hashes": list(keys), "bytes": values.nbytes,
+                           "used": time.time()}
+            total = sum(block["bytes"] for block in index.values())
+            for old in sorted(index, key=lambda b: index[b]["used"]):
+                if total <= self.max_bytes:
+                    break
+                total -= index[old]["bytes"]
+                self._remove(index, old)
+            self._write_index(index)
+
+    def _remove(self, index, name):
+        del index[name]
+        try:
+            # readers that still map the file keep their copy until they let go of it
+            os.remove(self._path(name))
+        except OSError:
+            pass
+
+    # total bytes and number of blocks held
+    def stats(self):
+        with self._locked(False):
+            index = self._read_index()
+        return {"blocks": len(index), "bytes": sum(block["bytes"] for block in index.values()),
+                "max_bytes": self.max_bytes}
+
+    def clear(self):
+        with self._locked(True):
+            index = self._read_index()
+            for name in list(index):
+                self._remove(index, name)
+            self._write_index(index)
+
+
+# cache in the directory named by MSA_CACHE_DIR (size cap MSA_CACHE_MAX_BYTES), or None
+def from_environment():
+    root = os.environ.get(DIR_VARIABLE)
+    if not root:
+        return None
+    return MatrixCache(root, int(os.environ.get(MAX_BYTES_VARIABLE, DEFAULT_MAX_BYTES)))
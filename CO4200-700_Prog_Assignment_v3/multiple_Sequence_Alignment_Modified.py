@@ -1,13 +1,44 @@
 import math
 import sys
-import blosum as bl
-import numpy as np
-from sklearn.cluster import AgglomerativeClustering
+from lazy import lazy_import
+import instrumentation
+
+# the engines pull in numpy (and blosum when the table is first built), so they are
+# only loaded when a method first needs them
+frequency_profile = lazy_import("frequency_profile")
+gapped = lazy_import("gapped")
+guide_tree = lazy_import("guide_tree")
+incremental = lazy_import("incremental")
+kmer_distance = lazy_import("kmer_distance")
+pair_cache = lazy_import("pair_cache")
+progressive = lazy_import("progressive")
+refinement = lazy_import("refinement")
+sequence_store = lazy_import("sequence_store")
+sp_score = lazy_import("sp_score")
+substitution = lazy_import("substitution")
 
 
 class MultipleAlignment(object):
     d = 8 # gap penalty factor
-    blosum_50 = bl.BLOSUM(50, default=0) # imported BLOSUM50 substitution matrix that takes char inputs x and y
+    engine = "numpy" # "numpy" for frequency-profile alignment, "python" for the reference loops
+    dp_workers = 1 # processes for the tiled wavefront fill of one large profile alignment (None: all CPUs)
+    anchoring = False # merge profiles through shared conserved blocks, only filling the DP between them
+
+    # distance selects how the guide tree input is computed: "kimura" for Kimura distances
+    # from full pairwise profile alignments, "kmer" for the much cheaper k-mer distance estimate
+    #
+    # linkage is the guide tree method: "complete", "average" (UPGMA) or "nj" (neighbor joining)
+    #
+    # workers is the number of processes for independent guide tree merges (default: all CPUs)
+    #
+    # iterations is the number of refinement passes over the guide tree edges after the
+    # progressive alignment (0 for none) and time_budget caps the seconds they may take
+    def __init__(self, distance="kimura", linkage="complete", workers=None, iterations=0, time_budget=None):
+        self.distance = distance
+        self.linkage = linkage
+        self.workers = workers
+        self.iterations = iterations
+        self.time_budget = time_budget
 
     # outputs error and quits running. Used later to handle incorrect running
     @staticmethod
@@ -18,17 +49,17 @@ class MultipleAlignment(object):
     # substitution score for character pairs
     # e.g. will return -d if one of the two chars is -, returns 0 if both are -,
     # and returns BLOSUM50 score otherwise
+    #
+    # the gap scores are part of the shared substitution table, so this is a single lookup;
+    # the hot loops encode their sequences once and index the table directly instead
     def s(self, x, y):
-        if x == '-' and y == '-':
-            return 0
-        if x == '-' or y == '-':
-            return -MultipleAlignment.d
-        if x < 'A' or x > 'Z':
+        a = substitution.code(x)
+        b = substitution.code(y)
+        if a == substitution.INVALID:
             MultipleAlignment.error("s(x,y) called for illegal character x")
-        if y < 'A' or y > 'Z':
+        if b == substitution.INVALID:
             MultipleAlignment.error("s(x,y) called for illegal character y")
-
-        return MultipleAlignment.blosum_50[x][y]
+        return float(substitution.table(MultipleAlignment.d).rows[a][b])
 
     # gap penalty
     def gamma(self, g):
@@ -56,30 +87,106 @@ class MultipleAlignment(object):
     # and linear gap penalty
     #
     # alignment need to passed as an array of equal length
+    #
+    # the score is taken from per-column residue counts, O(columns * alphabet^2)
+    # instead of a call to s() for every pair of sequences in every column
     def scoreMultipleAlignment(self, A):
-        n = len(A[0])
-        score = 0
-        i = 0
-        while i < n:
-            j = 0
-            while j < len(A):
-                k = j + 1
-                while k < len(A):
-                    score += self.s(A[j][i], A[k][i])
-                    k += 1
-                j += 1
-            i += 1
-        return score
+        try:
+            rows = substitution.encode_rows(A)
+        except ValueError as e:
+            MultipleAlignment.error(str(e))
+        with instrumentation.span("score", rows=rows.shape[0], columns=rows.shape[1]):
+            return float(sp_score.sp_score(rows, substitution.table(MultipleAlignment.d).scores))
 
     # compute alignment between profile X and Y
     #
-    # X and Y are arrays of strings
+    # X and Y are arrays of strings (or single strings), sequences can also be given
+    # as arrays of residue codes, e.g. the views a SequenceStore hands out
     #
     # optimal alignment of profile X to profile Y is returned as an array of strings
-    def computeProfileAlignment(self, X,  Y):
+    #
+    # each profile is turned into per-column residue and gap counts, so the score of
+    # column i of X against column j of Y is a product of count vectors with BLOSUM50
+    # and the cost of a cell does not grow with the number of sequences
+    def computeProfileAlignment(self, X, Y):
+        if substitution.is_sequence(X):
+            X = [X]
+        if substitution.is_sequence(Y):
+            Y = [Y]
+        if MultipleAlignment.engine == "python":
+            # the reference loops work on characters, so encoded sequences are decoded first
+            X = [x if isinstance(x, str) else substitution.decode(x) for x in X]
+            Y = [y if isinstance(y, str) else substitution.decode(y) for y in Y]
+            return self.computeProfileAlignmentReference(X, Y)
+        try:
+            return frequency_profile.align(X, Y, MultipleAlignment.d, MultipleAlignment.dp_workers)
+        except ValueError as e:
+            MultipleAlignment.error(str(e))
+
+    # alignment of profile X to profile Y kept in gap-index form (see gapped.py): the result
+    # holds X, Y and the gap runs inserted into each instead of copies of every gapped row,
+    # X and Y can be GappedProfiles, sequences or arrays of strings
+    #
+    # the gapped strings are only built when strings() is called on the final profile
+    #
+    # every merge is timed as a "merge" event with the rows and columns of both profiles
+    def mergeProfiles(self, X, Y):
+        try:
+            X = gapped.profile(X)
+            Y = gapped.profile(Y)
+            with instrumentation.span("merge", rows=(X.size, Y.size), columns=(X.length, Y.length)):
+                if MultipleAlignment.engine == "python":
+                    return gapped.profile(self.computeProfileAlignment(X.strings(), Y.strings()))
+                return gapped.align(X, Y, MultipleAlignment.d, MultipleAlignment.dp_workers,
+                                    MultipleAlignment.anchoring)
+        except ValueError as e:
+            MultipleAlignment.error(str(e))
+
+    # banded version of computeProfileAlignment for similar profiles, the band follows the
+    # length difference and k-mers shared by the two consensus sequences (or is width
+    # diagonals either side when width is given) and is widened if the traceback reaches its edge
+    # or an edge is within the X drop of its row's best score (see banded.py)
+    def computeBandedProfileAlignment(self, X, Y, width=None):
+        if substitution.is_sequence(X):
+            X = [X]
+        if substitution.is_sequence(Y):
+            Y = [Y]
+        try:
+            return frequency_profile.align_banded(X, Y, MultipleAlignment.d, width)
+        except ValueError as e:
+            MultipleAlignment.error(str(e))
+
+    # alignment of profile X to profile Y through anchors: exact k-mer matches between the two
+    # consensus sequences, chained into a collinear set, are aligned column to column and the
+    # profile DP only fills the gaps between them, close to linear for well-conserved families
+    def computeAnchoredProfileAlignment(self, X, Y, k=None):
+        if substitution.is_sequence(X):
+            X = [X]
+        if substitution.is_sequence(Y):
+            Y = [Y]
+        try:
+            return frequency_profile.align_anchored(X, Y, MultipleAlignment.d, k)
+        except ValueError as e:
+            MultipleAlignment.error(str(e))
+
+    # computeProfileAlignment keeping only every k-th row of F (default about sqrt(len(X[0]))),
+    # for profiles too long for the packed traceback it normally keeps
+    def computeCheckpointedProfileAlignment(self, X, Y, k=None):
+        if substitution.is_sequence(X):
+            X = [X]
+        if substitution.is_sequence(Y):
+            Y = [Y]
+        try:
+            return frequency_profile.align_checkpointed(X, Y, MultipleAlignment.d, k)
+        except ValueError as e:
+            MultipleAlignment.error(str(e))
+
+    # compute alignment between profile X and Y with the original per-residue loops,
+    # kept as the reference for computeProfileAlignment
+    def computeProfileAlignmentReference(self, X,  Y):
         if isinstance(X, list) and isinstance(Y, list):
-            n = len(X[0])-1
-            m = len(Y[0])-1
+            n = len(X[0])
+            m = len(Y[0])
             # number of strings in x
             nX = len(X)
             nY = len(Y)
@@ -230,39 +337,42 @@ class MultipleAlignment(object):
             return self.computeProfileAlignment(X, Ya)
 
 
-    # compute multiple alignment for given set of sequences
-    #
-    # input sequences are passed as array of strings (can have different length)
-    #
-    # Resulting multiple alignment must be returned as array of strings
-    # (all sequences of equal length, with gap characters inserted where appropriate)
-    #
-    # this is where lines are selected to align with the preceeding lines, you will likely change this
-    # for part 3b
+    # alignment of two single sequences through the shared pair cache, each pair is only
+    # aligned once whichever order it is asked for in; returns a pair_cache.PairResult
+    def cachedProfileAlignment(self, x, y):
+        cache = pair_cache.shared
+        result = cache.get(x, y, "profile", MultipleAlignment.d)
+        if result is None:
+            xalligned, yalligned = self.computeProfileAlignment(x, y)
+            positions_scored = 0
+            exact_matches = 0
+            for i in range(0, len(xalligned)):
+                if xalligned[i] != "-" and yalligned[i] != "-":
+                    positions_scored += 1
+                    if xalligned[i] == yalligned[i]:
+                        exact_matches += 1
+            # scored directly, the "score" span is kept for whole alignments
+            table = substitution.table(MultipleAlignment.d).scores
+            score = float(sp_score.sp_score([xalligned, yalligned], table))
+            result = pair_cache.PairResult(score, exact_matches, positions_scored, xalligned, yalligned)
+            cache.put(x, y, "profile", MultipleAlignment.d, result)
+        return result
 
     ####Part 3i
     # This is  slightly modified version of the  kimura distance implementation
     # it uses the  compute profile alignment that is produced when aligning two sequences
     # the rest is the same  and in this version there is a try except catching if xalligned and/or yalligned are  empty.
+    # alignments go through the pair cache, so (i, j) and (j, i) are only aligned once
     def Kimuradistance(self,SequenceList):
         tempMatrix = []
         for sequence1 in SequenceList:
             TempList = []
             for sequence2 in SequenceList:
-                pair = self.computeProfileAlignment(sequence1, sequence2)
-                xalligned = pair[0]
-                yalligned = pair[1]
-
-                positions_scored = 0
-                exact_matches = 0
+                pair = self.cachedProfileAlignment(sequence1, sequence2)
+                positions_scored = pair.scored
+                exact_matches = pair.matches
                 distance = -1
                 try:
-                    for i in range(0, len(xalligned)):
-                        if xalligned[i] != "-" and yalligned[i] != "-":
-                            positions_scored += 1
-                            if xalligned[i] == yalligned[i]:
-                                exact_matches += 1
-
                     S = exact_matches / positions_scored
                     D = 1 - S
                     distance = -math.log(1 - D - 0.2 * (D ** 2))
@@ -274,35 +384,92 @@ class MultipleAlignment(object):
         return tempMatrix
 
 
+    # k-mer distance estimate (MUSCLE stage 1 style), 1 - the fraction of shared k-mers over
+    # a compressed alphabet, for every pair; no alignments are computed
+    def kmerDistance(self, SequenceList):
+        try:
+            return kmer_distance.kmer_distance(SequenceList)
+        except ValueError as e:
+            MultipleAlignment.error(str(e))
+
+    # distance matrix used for the guide tree, as selected by self.distance
+    def distanceMatrix(self, X):
+        if self.distance == "kmer":
+            return self.kmerDistance(X)
+        if self.distance == "kimura":
+            return self.Kimuradistance(X)
+        MultipleAlignment.error("unknown distance " + str(self.distance))
+
+    # compute multiple alignment for given set of sequences
+    #
+    # input sequences are passed as array of strings (can have different length)
+    #
+    # Resulting multiple alignment must be returned as array of strings
+    # (all sequences of equal length, with gap characters inserted where appropriate)
+    #
+    # this is where lines are selected to align with the preceeding lines, you will likely change this
+    # for part 3b
+    #
+    # every internal node of the guide tree gets its own profile, aligned from the profiles
+    # of its two children, and merges whose children are done run in parallel; the profiles
+    # are kept in gap-index form and only the final one is turned into strings
     def computeMultipleAlignment(self, X) :
 
         # if the input only has one sequence then do no comparison
         if len(X) <= 1:
-            return X
+            return [x if isinstance(x, str) else substitution.decode(x) for x in X]
 
-        DistanceMatrix = self.Kimuradistance(X)
+        with instrumentation.span("distance", method=self.distance, sequences=len(X)):
+            DistanceMatrix = self.distanceMatrix(X)
 
         #### Part 3ii and 3a and 3b
         ## using the distance matrix  a guide tree is produced by the  agglomerative clustering
-        model = AgglomerativeClustering(linkage='complete', metric='precomputed', distance_threshold=None)
-        cluster = model.fit(np.array(DistanceMatrix))
+        ## (built in, same trees as sklearn's AgglomerativeClustering for complete linkage)
+        try:
+            with instrumentation.span("guide_tree", method=self.linkage):
+                cluster = guide_tree.build(DistanceMatrix, self.linkage)
+        except ValueError as e:
+            MultipleAlignment.error(str(e))
 
         # the clustering children that is in the form of (0, [3, 7]).
         # Can be translated it into
-        # align sequence 3 with 7  in step 0  and continue in the loop
-        # this makes user that A is defined for the rest of the steps
-        # if  step is other than that like (2,[6,9]) align each one progressively with the rest of the cluster
-        #  finally the allignment
-        for i, merge in enumerate(cluster.children_):
-            if i == 0:
-                A = self.computeProfileAlignment(X[merge[0]],X[merge[1]])
-                continue
-            for index in merge:
-                if index < len(X):
-                    A = self.computeProfileAlignment(A, X[index])
+        # align node 3 with node 7 in step 0, giving node len(X) + 0
+        # nodes below len(X) are the input sequences, the others are the profiles of earlier steps,
+        # so a step like (2, [6, 11]) aligns sequence 6 with the whole cluster built in step 1
+        #  finally the allignment is the profile of the last step
+        with instrumentation.span("progressive", workers=self.workers):
+            A = progressive.align_tree(cluster.children_, list(X), self.mergeProfiles, self.workers).strings()
+        if self.iterations > 0:
+            with instrumentation.span("refine", iterations=self.iterations):
+                A = self.refineAlignment(A, cluster.children_)
+        return A
+
+    # iterative refinement: the alignment is split in two at each guide tree edge, the two
+    # sub-profiles are realigned with computeProfileAlignment and the result kept when the
+    # sum-of-pairs score goes up; A must have its rows in the order progressive.align_tree gives
+    def refineAlignment(self, A, children):
+        A, _ = refinement.refine(A, children, self.computeProfileAlignment,
+                                 substitution.table(MultipleAlignment.d).scores,
+                                 self.iterations, self.time_budget, self.workers)
         return A
 
 
+    # adds the new sequences X to the existing multiple alignment A without realigning A
+    #
+    # every new sequence is aligned on its own to the frequency profile of A, then the
+    # insertions of all of them are merged in one pass (see incremental.py), so the cost is
+    # O(len(X) * L^2) instead of a new distance matrix and progressive alignment;
+    # each new row is placed below the row of A it is nearest to by k-mer distance
+    def addSequences(self, A, X):
+        if len(A) == 0:
+            return self.computeMultipleAlignment(X)
+        try:
+            with instrumentation.span("add", rows=len(A), sequences=len(X)):
+                rows, _ = incremental.add(A, list(X), MultipleAlignment.d)
+        except ValueError as e:
+            MultipleAlignment.error(str(e))
+        return [substitution.decode(row) for row in rows]
+
     # main method
     @staticmethod
     def main(Args):
@@ -310,27 +477,24 @@ class MultipleAlignment(object):
         inputfilename = "multiple32.txt"
         print("Reading input sequences from file " + inputfilename)
 
-        # read file
-        with open(f'./sequences/{inputfilename}') as f:
-            lines = f.readlines()
-
-        # get number of sequences in file
-        number_of_sequences = int(lines[0])
-
-        N = number_of_sequences
-        n = int(N)
-        print('number of sequence',n)
-        X = [None] * (n)
-        i = 0
-
-        while i < n:
-            X[i] = lines[i+1]
-            if X[i] is None:
-                MultipleAlignment.error("Unexpected end of file encountered")
-            i += 1
-
-        # create MultipleAlignment object
-        a = MultipleAlignment()
+        # --trace FILE writes timings and counters of every phase to FILE as JSON lines
+        log = None
+        if "--trace" in Args and Args.index("--trace") + 1 < len(Args):
+            log = instrumentation.log_to(Args[Args.index("--trace") + 1])
+
+        # read file into one encoded store, the aligners work on its views directly
+        try:
+            X = sequence_store.SequenceStore.from_file(f'./sequences/{inputfilename}')
+        except (OSError, ValueError) as e:
+            MultipleAlignment.error(str(e))
+        print('number of sequence', len(X))
+
+        # create MultipleAlignment object, --kmer uses k-mer distances for the guide tree,
+        # --refine adds refinement passes after the progressive alignment and --anchor
+        # merges profiles through their shared conserved blocks
+        MultipleAlignment.anchoring = "--anchor" in Args
+        a = MultipleAlignment(distance="kmer" if "--kmer" in Args else "kimura",
+                              iterations=refinement.DEFAULT_ITERATIONS if "--refine" in Args else 0)
 
         # function called to construct pairwise alignment for X sequence array
         A = a.computeMultipleAlignment(X)
@@ -338,6 +502,9 @@ class MultipleAlignment(object):
         print("Computed alignment:")
         a.displayAlignment(A)
         print("Score of alignment: " + str(a.scoreMultipleAlignment(A)))
+        if log is not None:
+            instrumentation.summary()
+            log.close()
 
 
 if __name__=="__main__":
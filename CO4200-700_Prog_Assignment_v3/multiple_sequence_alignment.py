@@ -1,9 +1,16 @@
 import sys
-import blosum as bl
+import frequency_profile
+import gapped
+import instrumentation
+from sequence_store import SequenceStore
+import sp_score
+import substitution
 
 class MultipleAlignment(object):
     d = 8 # gap penalty factor
-    blosum_50 = bl.BLOSUM(50, default=0) # imported BLOSUM50 substitution matrix that takes char inputs x and y
+    engine = "numpy" # "numpy" for frequency-profile alignment, "python" for the reference loops
+    dp_workers = 1 # processes for the tiled wavefront fill of one large profile alignment (None: all CPUs)
+    anchoring = False # merge profiles through shared conserved blocks, only filling the DP between them
 
     # outputs error and quits running. Used later to handle incorrect running
     @staticmethod
@@ -14,17 +21,17 @@ class MultipleAlignment(object):
     # substitution score for character pairs
     # e.g. will return -d if one of the two chars is -, returns 0 if both are -,
     # and returns BLOSUM50 score otherwise
+    #
+    # the gap scores are part of the shared substitution table, so this is a single lookup;
+    # the hot loops encode their sequences once and index the table directly instead
     def s(self, x, y):
-        if x == '-' and y == '-':
-            return 0
-        if x == '-' or y == '-':
-            return -MultipleAlignment.d
-        if x < 'A' or x > 'Z':
+        a = substitution.code(x)
+        b = substitution.code(y)
+        if a == substitution.INVALID:
             MultipleAlignment.error("s(x,y) called for illegal character x")
-        if y < 'A' or y > 'Z':
+        if b == substitution.INVALID:
             MultipleAlignment.error("s(x,y) called for illegal character y")
-
-        return MultipleAlignment.blosum_50[x][y]
+        return float(substitution.table(MultipleAlignment.d).rows[a][b])
 
     # gap penalty
     def gamma(self, g):
@@ -52,30 +59,106 @@ class MultipleAlignment(object):
     # and linear gap penalty
     #
     # alignment need to passed as an array of equal length
+    #
+    # the score is taken from per-column residue counts, O(columns * alphabet^2)
+    # instead of a call to s() for every pair of sequences in every column
     def scoreMultipleAlignment(self, A):
-        n = len(A[0])
-        score = 0
-        i = 0
-        while i < n:
-            j = 0
-            while j < len(A):
-                k = j + 1
-                while k < len(A):
-                    score += self.s(A[j][i], A[k][i])
-                    k += 1
-                j += 1
-            i += 1
-        return score
+        try:
+            rows = substitution.encode_rows(A)
+        except ValueError as e:
+            MultipleAlignment.error(str(e))
+        with instrumentation.span("score", rows=rows.shape[0], columns=rows.shape[1]):
+            return float(sp_score.sp_score(rows, substitution.table(MultipleAlignment.d).scores))
 
     # compute alignment between profile X and Y
     #
-    # X and Y are arrays of strings
+    # X and Y are arrays of strings (or single strings), sequences can also be given
+    # as arrays of residue codes, e.g. the views a SequenceStore hands out
     #
     # optimal alignment of profile X to profile Y is returned as an array of strings
-    def computeProfileAlignment(self, X,  Y):
+    #
+    # each profile is turned into per-column residue and gap counts, so the score of
+    # column i of X against column j of Y is a product of count vectors with BLOSUM50
+    # and the cost of a cell does not grow with the number of sequences
+    def computeProfileAlignment(self, X, Y):
+        if substitution.is_sequence(X):
+            X = [X]
+        if substitution.is_sequence(Y):
+            Y = [Y]
+        if MultipleAlignment.engine == "python":
+            # the reference loops work on characters, so encoded sequences are decoded first
+            X = [x if isinstance(x, str) else substitution.decode(x) for x in X]
+            Y = [y if isinstance(y, str) else substitution.decode(y) for y in Y]
+            return self.computeProfileAlignmentReference(X, Y)
+        try:
+            return frequency_profile.align(X, Y, MultipleAlignment.d, MultipleAlignment.dp_workers)
+        except ValueError as e:
+            MultipleAlignment.error(str(e))
+
+    # alignment of profile X to profile Y kept in gap-index form (see gapped.py): the result
+    # holds X, Y and the gap runs inserted into each instead of copies of every gapped row,
+    # X and Y can be GappedProfiles, sequences or arrays of strings
+    #
+    # the gapped strings are only built when strings() is called on the final profile
+    #
+    # every merge is timed as a "merge" event with the rows and columns of both profiles
+    def mergeProfiles(self, X, Y):
+        try:
+            X = gapped.profile(X)
+            Y = gapped.profile(Y)
+            with instrumentation.span("merge", rows=(X.size, Y.size), columns=(X.length, Y.length)):
+                if MultipleAlignment.engine == "python":
+                    return gapped.profile(self.computeProfileAlignment(X.strings(), Y.strings()))
+                return gapped.align(X, Y, MultipleAlignment.d, MultipleAlignment.dp_workers,
+                                    MultipleAlignment.anchoring)
+        except ValueError as e:
+            MultipleAlignment.error(str(e))
+
+    # banded version of computeProfileAlignment for similar profiles, the band follows the
+    # length difference and k-mers shared by the two consensus sequences (or is width
+    # diagonals either side when width is given) and is widened if the traceback reaches its edge
+    # or an edge is within the X drop of its row's best score (see banded.py)
+    def computeBandedProfileAlignment(self, X, Y, width=None):
+        if substitution.is_sequence(X):
+            X = [X]
+        if substitution.is_sequence(Y):
+            Y = [Y]
+        try:
+            return frequency_profile.align_banded(X, Y, MultipleAlignment.d, width)
+        except ValueError as e:
+            MultipleAlignment.error(str(e))
+
+    # alignment of profile X to profile Y through anchors: exact k-mer matches between the two
+    # consensus sequences, chained into a collinear set, are aligned column to column and the
+    # profile DP only fills the gaps between them, close to linear for well-conserved families
+    def computeAnchoredProfileAlignment(self, X, Y, k=None):
+        if substitution.is_sequence(X):
+            X = [X]
+        if substitution.is_sequence(Y):
+            Y = [Y]
+        try:
+            return frequency_profile.align_anchored(X, Y, MultipleAlignment.d, k)
+        except ValueError as e:
+            MultipleAlignment.error(str(e))
+
+    # computeProfileAlignment keeping only every k-th row of F (default about sqrt(len(X[0]))),
+    # for profiles too long for the packed traceback it normally keeps
+    def computeCheckpointedProfileAlignment(self, X, Y, k=None):
+        if substitution.is_sequence(X):
+            X = [X]
+        if substitution.is_sequence(Y):
+            Y = [Y]
+        try:
+            return frequency_profile.align_checkpointed(X, Y, MultipleAlignment.d, k)
+        except ValueError as e:
+            MultipleAlignment.error(str(e))
+
+    # compute alignment between profile X and Y with the original per-residue loops,
+    # kept as the reference for computeProfileAlignment
+    def computeProfileAlignmentReference(self, X,  Y):
         if isinstance(X, list) and isinstance(Y, list):
-            n = len(X[0])-1
-            m = len(Y[0])-1
+            n = len(X[0])
+            m = len(Y[0])
             # number of strings in x
             nX = len(X)
             nY = len(Y)
@@ -239,16 +322,16 @@ class MultipleAlignment(object):
 
         # if the input only has one sequence then do no comparison
         if len(X) <= 1:
-            return X
+            return [x if isinstance(x, str) else substitution.decode(x) for x in X]
         # this is what computes the alignment
-        A = self.computeProfileAlignment(X[0], X[1])
+        # the profile is kept in gap-index form, see mergeProfiles
+        A = self.mergeProfiles(X[0], X[1])
         i = 2
         while i < len(X):
-            print (A)
-            A = self.computeProfileAlignment(A, X[i])
+            A = self.mergeProfiles(A, X[i])
             i += 1
 
-        return A
+        return A.strings()
 
     # main method
     @staticmethod
@@ -257,25 +340,17 @@ class MultipleAlignment(object):
         inputfilename = "multiple10.txt"
         print("Reading input sequences from file " + inputfilename)
 
-        # read file
-        with open(f'./sequences/{inputfilename}') as f:
-            lines = f.readlines()
+        # --trace FILE writes timings and counters of every phase to FILE as JSON lines
+        log = None
+        if "--trace" in Args and Args.index("--trace") + 1 < len(Args):
+            log = instrumentation.log_to(Args[Args.index("--trace") + 1])
 
-        # get number of sequences in file
-        number_of_sequences = int(lines[0])
-
-        N = number_of_sequences
-        n = int(N)
-        print('number of sequence',n)
-        X = [None] * (n)
-        i = 0
-
-
-        while i < n:
-            X[i] = lines[i+1]
-            if X[i] is None:
-                MultipleAlignment.error("Unexpected end of file encountered")
-            i += 1
+        # read file into one encoded store, the aligners work on its views directly
+        try:
+            X = SequenceStore.from_file(f'./sequences/{inputfilename}')
+        except (OSError, ValueError) as e:
+            MultipleAlignment.error(str(e))
+        print('number of sequence', len(X))
 
         # create MultipleAlignment object
         a = MultipleAlignment()
@@ -286,6 +361,9 @@ class MultipleAlignment(object):
         print("Computed alignment:")
         a.displayAlignment(A)
         print("Score of alignment: " + str(a.scoreMultipleAlignment(A)))
+        if log is not None:
+            instrumentation.summary()
+            log.close()
 
 
 if __name__=="__main__":
@@ -0,0 +1,122 @@
+import hashlib
+from collections import OrderedDict
+
+import numpy as np
+
+import instrumentation
+import substitution
+
+"""
+In-memory cache of pairwise alignment results shared by Part2, Part3i and
+MultipleAlignment.
+
+Entries are keyed by a content hash of both sequences, the substitution matrix,
+the gap penalty and the alignment method. The two sequence hashes are put in a
+fixed order, so (x, y) and (y, x) find the same entry; a result stored for the
+other order comes back with its gapped strings swapped. The cache is bounded
+by an estimate of the bytes it holds and evicts the least recently used entry.
+"""
+
+MATRIX = "BLOSUM50" # name of the substitution matrix every engine uses
+
+DEFAULT_MAX_BYTES = 64 * 1024 * 1024
+
+ENTRY_BYTES = 200 # rough size of an entry without its gapped strings
+
+
+class PairResult(object):
+    __slots__ = ("score", "matches", "scored", "xa", "ya")
+
+    # score, exact matches and positions scored (no gap) of one alignment,
+    # xa and ya are the gapped strings when they were kept
+    def __init__(self, score, matches, scored, xa=None, ya=None):
+        self.score = score
+        self.matches = matches
+        self.scored = scored
+        self.xa = xa
+        self.ya = ya
+
+    def swapped(self):
+        return PairResult(self.score, self.matches, self.scored, self.ya, self.xa)
+
+    def size(self):
+        size = ENTRY_BYTES
+        if self.xa is not None:
+            size += len(self.xa) + len(self.ya)
+        return size
+
+
+# content hash of one sequence, given as a string or as encoded codes (both hash the same)
+def sequence_hash(seq):
+    if isinstance(seq, np.ndarray):
+        data = substitution.CHARS[seq].tobytes()
+    else:
+        data = seq.encode('ascii')
+    return hashlib.blake2b(data, digest_size=16).digest()
+
+
+class PairCache(object):
+
+    # max_bytes caps the estimated memory held by the entries
+    def __init__(self, max_bytes=DEFAULT_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    # key of the pair and whether x and y were swapped to build it
+    @staticmethod
+    def key(x, y, method, d):
+        hx = sequence_hash(x)
+        hy = sequence_hash(y)
+        swapped = hx > hy
+        if swapped:
+            hx, hy = hy, hx
+        params = ("%s|%s|%d|" % (MATRIX, method, d)).encode('ascii')
+        return hashlib.blake2b(params + hx + hy, digest_size=20).digest(), swapped
+
+    # cached result for aligning x to y, or None
+    def get(self, x, y, method, d):
+        key, swapped = PairCache.key(x, y, method, d)
+        result = self.entries.get(key)
+        if result is None:
+            self.misses += 1
+            instrumentation.count("cache_misses")
+            return None
+        self.hits += 1
+        instrumentation.count("cache_hits")
+        self.entries.move_to_end(key)
+        return result.swapped() if swapped else result
+
+    # stores the result of aligning x to y, evicting old entries to stay under max_bytes
+    def put(self, x, y, method, d, result):
+        key, swapped = PairCache.key(x, y, method, d)
+        if swapped:
+            result = result.swapped()
+        old = self.entries.pop(key, None)
+        if old is not None:
+            self.bytes -= old.size()
+        size = result.size()
+        if size > self.max_bytes:
+            return
+        self.entries[key] = result
+        self.bytes += size
+        while self.bytes > self.max_bytes:
+            _, evicted = self.entries.popitem(last=False)
+            self.bytes -= evicted.size()
+            self.evictions += 1
+
+    def clear(self):
+        self.entries.clear()
+        self.bytes = 0
+
+    # counters for sizing the cache
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, "evictions": self.evictions,
+                "entries": len(self.entries), "bytes": self.bytes, "max_bytes": self.max_bytes}
+
+
+# cache shared by every module in this process
+shared = PairCache()
@@ -0,0 +1,108 @@
+import os
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+
+import instrumentation
+
+"""
+Guide-tree driven progressive alignment.
+
+The tree is given in the children_ format of a fitted
+sklearn.cluster.AgglomerativeClustering: merge k joins nodes children[k][0]
+and children[k][1] into node n_leaves + k, where nodes below n_leaves are the
+input sequences. Every internal node gets its own profile, aligned from the
+profiles of its two children. Nodes whose children are both done are
+independent of each other, so they are run on a process pool as soon as they
+become ready; on a balanced tree the longest chain of merges is about log N
+instead of N. What a merge in a worker records in instrumentation is sent
+back with its profile and merged in this process.
+"""
+
+# fewer sequences than this are aligned in this process
+PARALLEL_LEAVES = 16
+
+
+# for every merge, the merge that consumes its result (None for the root)
+def _parents(children, n_leaves):
+    parent = [None] * len(children)
+    for k, (a, b) in enumerate(children):
+        for child in (a, b):
+            if child >= n_leaves:
+                parent[child - n_leaves] = k
+    return parent
+
+
+# number of merges on the longest path from a leaf to the root
+def depth(children, n_leaves):
+    d = [0] * len(children)
+    for k, (a, b) in enumerate(children):
+        da = d[a - n_leaves] if a >= n_leaves else 0
+        db = d[b - n_leaves] if b >= n_leaves else 0
+        d[k] = max(da, db) + 1
+    return max(d) if d else 0
+
+
+# rows of every node's profile within the root profile, as (start, end) for
+# nodes 0 .. 2 * n_leaves - 2; align_tree puts the rows of a merge's first child
+# before those of its second, so every subtree is a contiguous block of rows
+def spans(children, n_leaves):
+    size = [1] * n_leaves
+    for a, b in children:
+        size.append(size[a] + size[b])
+    start = [0] * len(size)
+    for k in range(len(children) - 1, -1, -1):
+        a, b = children[k]
+        start[a] = start[n_leaves + k]
+        start[b] = start[a] + size[a]
+    return [(start[k], start[k] + size[k]) for k in range(len(size))]
+
+
+# align(X, Y) in a worker process, returned with what it recorded in instrumentation
+def _merge(on, align, X, Y):
+    return instrumentation.collect(on, align, X, Y)
+
+
+# aligns the profiles of the whole tree and returns the profile of the root
+#
+# leaves[k] is the profile (or sequence) of leaf k and align(X, Y) aligns two
+# profiles; with more than one worker align must be picklable, e.g. a bound
+# method of a module-level class
+def align_tree(children, leaves, align, workers=None):
+    n_leaves = len(leaves)
+    if len(children) == 0:
+        return leaves[0]
+    if workers is None:
+        workers = os.cpu_count() or 1
+    profiles = dict(enumerate(leaves))
+
+    if workers <= 1 or n_leaves < PARALLEL_LEAVES:
+        # children_ is in merge order, so every merge's inputs exist when it is reached
+        for k, (a, b) in enumerate(children):
+            profiles[n_leaves + k] = align(profiles.pop(a), profiles.pop(b))
+        return profiles[n_leaves + len(children) - 1]
+
+    parent = _parents(children, n_leaves)
+    # merges still waiting for one or both children
+    waiting = [sum(1 for c in pair if c >= n_leaves) for pair in children]
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        running = {}
+
+        def submit(k):
+            a, b = children[k]
+            future = pool.submit(_merge, instrumentation.enabled, align, profiles.pop(a), profiles.pop(b))
+            running[future] = k
+
+        for k in range(len(children)):
+            if waiting[k] == 0:
+                submit(k)
+        while running:
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                k = running.pop(future)
+                profiles[n_leaves + k], recorded = future.result()
+                instrumentation.merge(recorded)
+                p = parent[k]
+                if p is not None:
+                    waiting[p] -= 1
+                    if waiting[p] == 0:
+                        submit(p)
+    return profiles[n_leaves + len(children) - 1]
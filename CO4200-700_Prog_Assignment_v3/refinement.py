@@ -0,0 +1,107 @@
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+import progressive
+import substitution
+from sp_score import SPScorer
+from substitution import GAP
+
+"""
+Iterative refinement of a progressive alignment, in the style of MUSCLE.
+
+Removing one edge of the guide tree splits the rows into two groups. Each
+group, with its all-gap columns dropped, is a profile; the two profiles are
+realigned and the result is kept if it scores better. Realigning only inserts
+all-gap columns into each group, which score 0 against each other, so the
+pairs inside a group keep their score and the change of the sum-of-pairs score
+is just the change of the score between the groups. An SPScorer holds the
+column counts of the current alignment, so that change only needs the counts
+of the realigned group and of the candidate, not a rescoring of the alignment.
+
+With more than one worker, the candidates of several edges are computed at the
+same time from the current alignment; the best improving one is applied and
+the other improving edges are tried again on the new alignment.
+"""
+
+DEFAULT_ITERATIONS = 2
+
+# fewer rows than this are refined in this process
+PARALLEL_ROWS = 16
+
+
+# rows with their all-gap columns removed
+def _strip(rows):
+    return rows[:, (rows != GAP).any(axis=0)]
+
+
+# realigns the group rows[lo:hi] of the scorer's alignment against the other rows,
+# returns the new rows (in the same row order) and the change of the score
+def _candidate(align, scorer, lo, hi):
+    rows = scorer.rows
+    inside = _strip(rows[lo:hi])
+    outside = _strip(np.vstack((rows[:lo], rows[hi:])))
+    aligned = substitution.encode_rows(align(list(inside), list(outside)))
+    n = hi - lo
+    new = np.vstack((aligned[n:n + lo], aligned[:n], aligned[n + lo:]))
+    return new, scorer.delta_split(lo, hi, new)
+
+
+# edges of the guide tree as the (lo, hi) row block below them, leaves first;
+# the two edges at the root give the same split, so only one of them is kept
+def edges(children, n_leaves):
+    blocks = progressive.spans(children, n_leaves)[:-1]
+    del blocks[children[-1][1]]
+    return blocks
+
+
+# refines rows, the root profile of progressive.align_tree for the guide tree
+# children, with align(X, Y) the profile aligner used to build it
+#
+# each iteration visits every edge once and stops early when none improves;
+# budget is a limit on the seconds spent, checked before each realignment
+# returns the refined rows as strings and the change of the score
+def refine(rows, children, align, table, iterations=DEFAULT_ITERATIONS, budget=None, workers=None):
+    rows = substitution.encode_rows(rows)
+    n_leaves = rows.shape[0]
+    if n_leaves < 3:
+        return [substitution.decode(row) for row in rows], 0
+    scorer = SPScorer(rows, table)
+    if workers is None:
+        workers = os.cpu_count() or 1
+    if n_leaves < PARALLEL_ROWS:
+        workers = 1
+    deadline = None if budget is None else time.perf_counter() + budget
+    blocks = edges(children, n_leaves)
+    gain = 0
+    pool = ProcessPoolExecutor(max_workers=workers) if workers > 1 else None
+    try:
+        for _ in range(iterations):
+            improved = False
+            queue = list(blocks)
+            while queue:
+                if deadline is not None and time.perf_counter() > deadline:
+                    break
+                batch = queue[:workers]
+                del queue[:workers]
+                if pool is None:
+                    results = [_candidate(align, scorer, lo, hi) for lo, hi in batch]
+                else:
+                    results = list(pool.map(_candidate, [align] * len(batch), [scorer] * len(batch),
+                                            [lo for lo, _ in batch], [hi for _, hi in batch]))
+                best = max(range(len(batch)), key=lambda k: results[k][1])
+                if results[best][1] <= 0:
+                    continue
+                lo, hi = batch[best]
+                gain += scorer.apply_split(lo, hi, _strip(results[best][0]))
+                improved = True
+                # the other improving candidates were made from the old alignment
+                queue[:0] = [batch[k] for k in range(len(batch)) if k != best and results[k][1] > 0]
+            if not improved or (deadline is not None and time.perf_counter() > deadline):
+                break
+    finally:
+        if pool is not None:
+            pool.shutdown()
+    return [substitution.decode(row) for row in scorer.rows], gain
@@ -0,0 +1,196 @@
+import argparse
+import heapq
+import sys
+
+import numpy as np
+
+import instrumentation
+import linear_space
+import seqio
+import substitution
+from sequence_store import SequenceStore
+from substitution import GAP
+
+"""
+Search of one query against a sequence database for its closest members.
+
+The database is streamed record by record (a file through seqio, or any
+iterable of records, strings or code arrays), so it is never held whole.
+Only the best k hits are kept, in a min-heap whose root is the k-th best
+score so far. Before a target is aligned, two upper bounds on its score are
+checked against that root, and targets that cannot beat it are skipped:
+
+    length       every aligned pair scores at most the best score of its
+                 query residue against any residue, at most min(n, m) pairs
+                 are aligned and a global alignment has |n - m| gaps or more
+    composition  the same with the best score of each query residue against
+                 the residues the target holds, and of each target residue
+                 against the residues the query holds (1-mer counts)
+
+Targets that pass are aligned BATCH at a time in one vectorised pass
+(linear_space.scores_many), global (Needleman-Wunsch) or local
+(Smith-Waterman). The bounds are checked again when a batch is run, against
+the heap as it is by then.
+
+    python search.py QUERY_FILE DATABASE_FILE -k 10 --mode local
+"""
+
+GLOBAL = "global"
+LOCAL = "local"
+MODES = [GLOBAL, LOCAL]
+
+DEFAULT_K = 10
+
+# most targets aligned against the query in a single vectorised pass
+BATCH = 64
+
+
+class Hit(object):
+    __slots__ = ("score", "id", "index", "length")
+
+    # index is the 0-based position of the target in the database
+    def __init__(self, score, id, index, length):
+        self.score = score
+        self.id = id
+        self.index = index
+        self.length = length
+
+    def __repr__(self):
+        return "Hit(%r, %r, %d, %d)" % (self.score, self.id, self.index, self.length)
+
+
+# sum of the p largest values, value k counted counts[k] times
+def _top_sum(values, counts, p):
+    order = np.argsort(-values, kind='stable')
+    values = values[order]
+    counts = counts[order]
+    before = np.cumsum(counts) - counts
+    return int((values * np.clip(p - before, 0, counts)).sum())
+
+
+class _Bounds(object):
+    __slots__ = ("n", "table", "floor", "local", "d", "prefix", "counts", "column_best")
+
+    # upper bounds on the scores of encoded query x against any target
+    def __init__(self, x, table, d, local):
+        self.n = len(x)
+        self.table = table
+        self.local = local
+        self.d = d
+        # a pair scoring below floor is never worth aligning: a local alignment leaves it out and
+        # a global one can put two gaps (-2d) in its place
+        self.floor = 0 if local else -2 * d
+        best = np.maximum(table.max(axis=1)[x], self.floor)
+        self.prefix = np.concatenate(([0], np.cumsum(np.sort(best)[::-1])))
+        self.counts = np.bincount(x, minlength=GAP)
+        # best score of every target residue against the residues of the query
+        self.column_best = np.maximum(table[self.counts > 0].max(axis=0, initial=self.floor), self.floor)
+
+    def _gaps(self, m):
+        return 0 if self.local else self.d * abs(self.n - m)
+
+    def length(self, m):
+        return int(self.prefix[min(self.n, m)]) - self._gaps(m)
+
+    def composition(self, y):
+        m = len(y)
+        counts = np.bincount(y, minlength=GAP)
+        p = min(self.n, m)
+        # best score of every query residue against the residues of the target
+        row_best = np.maximum(self.table[:, counts > 0].max(axis=1, initial=self.floor), self.floor)
+        return min(_top_sum(row_best, self.counts, p), _top_sum(self.column_best, counts, p)) - self._gaps(m)
+
+
+# (id, codes) of every target of a database: a sequence file path, a SequenceStore or
+# an iterable of seqio records, strings or code arrays
+def _targets(database, fmt=None):
+    if isinstance(database, str):
+        for record in seqio.read_sequences(database, fmt):
+            yield record.id, record.codes
+    elif isinstance(database, SequenceStore):
+        for k in range(len(database)):
+            yield database.ids[k], database[k]
+    else:
+        for k, item in enumerate(database):
+            if isinstance(item, seqio.Record):
+                yield item.id, item.codes
+            else:
+                yield str(k + 1), substitution.encode(item)
+
+
+# the k best hits of query against database, best first (ties in database order)
+#
+# mode is GLOBAL or LOCAL, d the gap penalty; prune=False aligns every target
+def search(query, database, k=DEFAULT_K, mode=GLOBAL, d=8, fmt=None, prune=True):
+    if mode not in MODES:
+        raise ValueError("unknown search mode " + repr(mode))
+    if k < 1:
+        raise ValueError("k must be at least 1")
+    x = substitution.encode(query)
+    local = mode == LOCAL
+    table = substitution.table(d).residues
+    bounds = _Bounds(x, table, d, local)
+    # entries (score, -index, id, length): the root is the worst hit, of two equal scores the later one
+    heap = []
+    pending = []
+    skipped = 0
+
+    def beats(bound):
+        return not prune or len(heap) < k or bound > heap[0][0]
+
+    def run():
+        nonlocal skipped
+        batch = [t for t in pending if beats(t[3])]
+        skipped += len(pending) - len(batch)
+        del pending[:]
+        if not batch:
+            return
+        scores = linear_space.scores_many(x, [t[2] for t in batch], table, d, local)
+        for (index, id, y, _), score in zip(batch, scores):
+            entry = (int(score), -index, id, len(y))
+            if len(heap) < k:
+                heapq.heappush(heap, entry)
+            elif entry > heap[0]:
+                heapq.heapreplace(heap, entry)
+
+    with instrumentation.span("search", mode=mode, k=k):
+        index = 0
+        for id, y in _targets(database, fmt):
+            if beats(bounds.length(len(y))):
+                bound = bounds.composition(y)
+                if beats(bound):
+                    pending.append((index, id, y, bound))
+                    if len(pending) == BATCH:
+                        run()
+                else:
+                    skipped += 1
+            else:
+                skipped += 1
+            index += 1
+        run()
+        instrumentation.count("search_targets", index)
+        instrumentation.count("search_pruned", skipped)
+    return [Hit(float(score), id, -negative, length)
+            for score, negative, id, length in sorted(heap, key=lambda e: (-e[0], -e[1]))]
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Find the closest members of a sequence database to a query")
+    parser.add_argument("query", help="file holding the query (its first sequence)")
+    parser.add_argument("database", help="sequence file to search, in any format seqio reads")
+    parser.add_argument("-k", type=int, default=DEFAULT_K, help="number of hits to report (default %d)" % DEFAULT_K)
+    parser.add_argument("--mode", choices=MODES, default=GLOBAL, help="global (default) or local alignment")
+    parser.add_argument("-d", type=int, default=8, help="gap penalty (default 8)")
+    parser.add_argument("--no-prune", action="store_true", help="align every target, skipping no bounds")
+    args = parser.parse_args(argv)
+
+    query = next(iter(seqio.read_sequences(args.query)), None)
+    if query is None:
+        parser.error("no sequence in " + args.query)
+    for hit in search(query.codes, args.database, args.k, args.mode, args.d, prune=not args.no_prune):
+        print("%10.1f %6d %s" % (hit.score, hit.length, hit.id))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,133 @@
+import mmap
+import os
+
+import numpy as np
+
+from substitution import CODES, INVALID, decode
+
+"""
+Sequence input shared by every entry point.
+
+Reads FASTA files, the count-prefixed files in sequences/ (a line with the
+number of sequences, then one sequence per line) and plain one-per-line
+files. Records are streamed one at a time; each comes back stripped,
+validated and encoded as residue codes, straight from the bytes of the file.
+Files larger than MMAP_BYTES are memory-mapped instead of read through a
+buffered file object.
+"""
+
+MMAP_BYTES = 1 << 20
+
+FASTA = "fasta"
+COUNTED = "counted" # first line holds the number of sequences
+LINES = "lines" # one sequence per line
+
+
+class Record(object):
+    __slots__ = ("id", "codes")
+
+    # id is the FASTA header (or the 1-based position for the other formats),
+    # codes the sequence as residue codes
+    def __init__(self, id, codes):
+        self.id = id
+        self.codes = codes
+
+    def __len__(self):
+        return len(self.codes)
+
+    # the sequence as a string
+    def text(self):
+        return decode(self.codes)
+
+
+# bytes -> validated codes, where says which record or line to blame on errors
+def _encode(data, where):
+    codes = CODES[np.frombuffer(data, dtype=np.uint8)]
+    if (codes == INVALID).any():
+        bad = bytes([data[int(np.argmax(codes == INVALID))]])
+        raise ValueError("illegal character %r in %s" % (bad.decode('latin-1'), where))
+    return codes
+
+
+# yields the lines of a file as bytes, from a memory map for large files
+def _lines(path):
+    size = os.path.getsize(path)
+    with open(path, 'rb') as f:
+        if size >= MMAP_BYTES:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+                line = m.readline()
+                while line:
+                    yield line
+                    line = m.readline()
+        else:
+            for line in f:
+                yield line
+
+
+# format of a file from its first non-empty line
+def detect_format(path):
+    for line in _lines(path):
+        line = line.strip()
+        if not line:
+            continue
+        if line.startswith(b'>'):
+            return FASTA
+        if line.isdigit():
+            return COUNTED
+        return LINES
+    return LINES
+
+
+def _read_fasta(path):
+    header = None
+    parts = []
+    for line in _lines(path):
+        line = line.strip()
+        if line.startswith(b'>'):
+            if header is not None:
+                yield Record(header, _encode(b''.join(parts), "record " + header))
+            header = line[1:].decode('utf-8', 'replace').strip()
+            parts = []
+        elif line:
+            if header is None:
+                raise ValueError("sequence data before the first FASTA header in " + path)
+            parts.append(line)
+    if header is not None:
+        yield Record(header, _encode(b''.join(parts), "record " + header))
+
+
+def _read_lines(path, counted):
+    expected = None
+    k = 0
+    for number, line in enumerate(_lines(path), 1):
+        line = line.strip()
+        if not line:
+            continue
+        if counted and expected is None:
+            expected = int(line)
+            continue
+        if expected is not None and k == expected:
+            break
+        k += 1
+        yield Record(str(k), _encode(line, "line %d of %s" % (number, path)))
+    if expected is not None and k < expected:
+        raise ValueError("unexpected end of file: %s has %d of %d sequences" % (path, k, expected))
+
+
+# streams the records of a sequence file, fmt is FASTA, COUNTED or LINES and is
+# detected from the file when not given
+def read_sequences(path, fmt=None):
+    if fmt is None:
+        fmt = detect_format(path)
+    if fmt == FASTA:
+        return _read_fasta(path)
+    if fmt == COUNTED:
+        return _read_lines(path, True)
+    if fmt == LINES:
+        return _read_lines(path, False)
+    raise ValueError("unknown sequence format " + repr(fmt))
+
+
+# all sequences of a file as strings, for code that works on strings
+def read_strings(path, fmt=None):
+    return [record.text() for record in read_sequences(path, fmt)]
@@ -0,0 +1,113 @@
+import numpy as np
+
+import seqio
+import substitution
+
+"""
+Compact store for a set of encoded sequences.
+
+All sequences live in one contiguous uint8 buffer of residue codes, with an
+offsets array marking where each starts and a list of IDs. Indexing returns a
+zero-copy NumPy view of the buffer, which every alignment engine accepts in
+place of a string. A store can be saved to one file and opened again through
+a memory map, so large sets are paged in on demand instead of being loaded.
+"""
+
+MAGIC = b"SEQSTOR1"
+
+
+class SequenceStore(object):
+    __slots__ = ("buffer", "offsets", "ids")
+
+    # buffer holds the codes of all sequences back to back, sequence k is
+    # buffer[offsets[k]:offsets[k + 1]]
+    def __init__(self, buffer, offsets, ids):
+        self.buffer = buffer
+        self.offsets = offsets
+        self.ids = ids
+
+    # store from seqio records (or anything with id and codes)
+    @staticmethod
+    def from_records(records):
+        ids = []
+        parts = []
+        for record in records:
+            ids.append(record.id)
+            parts.append(record.codes)
+        offsets = np.zeros(len(parts) + 1, dtype=np.int64)
+        np.cumsum([len(p) for p in parts], out=offsets[1:])
+        buffer = np.concatenate(parts).astype(np.uint8, copy=False) if parts else np.empty(0, dtype=np.uint8)
+        return SequenceStore(buffer, offsets, ids)
+
+    # store from sequence strings, ids default to the 1-based positions
+    @staticmethod
+    def from_strings(SequenceList, ids=None):
+        if ids is None:
+            ids = [str(k + 1) for k in range(len(SequenceList))]
+        return SequenceStore.from_records(
+            seqio.Record(id, substitution.encode(seq)) for id, seq in zip(ids, SequenceList))
+
+    # store from a sequence file in any format seqio reads
+    @staticmethod
+    def from_file(path, fmt=None):
+        return SequenceStore.from_records(seqio.read_sequences(path, fmt))
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    # sequence k as a view into the buffer, a slice gives a list of views
+    def __getitem__(self, k):
+        if isinstance(k, slice):
+            return [self[i] for i in range(*k.indices(len(self)))]
+        if k < 0:
+            k += len(self)
+        if k < 0 or k >= len(self):
+            raise IndexError("sequence index out of range")
+        return self.buffer[self.offsets[k]:self.offsets[k + 1]]
+
+    def __iter__(self):
+        k = 0
+        while k < len(self):
+            yield self[k]
+            k += 1
+
+    def lengths(self):
+        return np.diff(self.offsets)
+
+    # sequence k as a memoryview of the buffer
+    def view(self, k):
+        return memoryview(self[k])
+
+    # sequence k as a string
+    def text(self, k):
+        return substitution.decode(self[k])
+
+    # writes the store to one file: magic, sequence count, buffer size, offsets,
+    # buffer, then the ids one per line
+    def save(self, path):
+        with open(path, 'wb') as f:
+            f.write(MAGIC)
+            np.array([len(self), len(self.buffer)], dtype=np.int64).tofile(f)
+            np.asarray(self.offsets, dtype=np.int64).tofile(f)
+            np.asarray(self.buffer, dtype=np.uint8).tofile(f)
+            f.write("\n".join(self.ids).encode('utf-8'))
+
+    # opens a saved store, the offsets and buffer are memory-mapped unless mmap=False
+    @staticmethod
+    def load(path, mmap=True):
+        with open(path, 'rb') as f:
+            if f.read(len(MAGIC)) != MAGIC:
+                raise ValueError(path + " is not a sequence store")
+            n, size = np.fromfile(f, dtype=np.int64, count=2)
+            start = len(MAGIC) + 16
+            f.seek(start + 8 * (n + 1) + size)
+            ids = f.read().decode('utf-8').split("\n") if n > 0 else []
+        if mmap and size > 0:
+            offsets = np.memmap(path, dtype=np.int64, mode='r', offset=start, shape=(n + 1,))
+            buffer = np.memmap(path, dtype=np.uint8, mode='r', offset=start + 8 * (n + 1), shape=(size,))
+        else:
+            with open(path, 'rb') as f:
+                f.seek(start)
+                offsets = np.fromfile(f, dtype=np.int64, count=n + 1)
+                buffer = np.fromfile(f, dtype=np.uint8, count=size)
+        return SequenceStore(buffer, offsets, ids)
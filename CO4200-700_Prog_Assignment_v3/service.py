@@ -0,0 +1,394 @@
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import instrumentation
+import substitution
+
+"""
+Long-running local alignment service.
+
+Every run of a script is a fresh interpreter that pays for the numpy and
+blosum imports and the substitution table build before it aligns anything.
+This service pays for them once: it keeps a process pool whose workers have
+imported the engines and built the table for the service's gap penalty at
+start-up, and answers JSON requests over HTTP on localhost or on a Unix
+socket:
+
+    POST /score      {"x": "...", "y": "..."}           -> {"score": s}
+                     {"x": "...", "targets": [...]}     -> {"scores": [...]}
+    POST /distances  {"sequences": [...], "method": "kimura" | "kmer"}
+                                                        -> {"matrix": [[...], ...]}
+    POST /msa        {"sequences": [...], "distance": ..., "linkage": ..., "refine": false}
+                                                        -> {"alignment": [...], "score": s}
+    GET  /health                                        -> {"pending": n, ...}
+
+Small requests are batched: each endpoint has a queue, and once a worker is
+free the requests waiting in it (up to MAX_BATCH, waiting at most DELAY
+seconds for more) go to the pool as one task. While every worker is busy
+the queues keep filling, so the busier the service the larger its batches.
+Scoring requests in a batch that share a query are aligned together in one
+vectorised pass.
+
+At most max_pending requests are admitted at a time; past that the service
+answers 503 with Retry-After at once instead of queueing without bound.
+Every response carries "timing": seconds queued, seconds of computation in
+the worker, total seconds in the service and the size of the batch it ran
+in.
+
+    python service.py --port 8750
+    python service.py --socket /tmp/msa.sock
+    curl -s --unix-socket /tmp/msa.sock localhost/score -d '{"x": "HEAGAWGHEE", "y": "PAWHEAE"}'
+"""
+
+DEFAULT_PORT = 8750
+DEFAULT_MAX_PENDING = 1024
+
+# most requests sent to a worker as one task, and seconds to wait for more
+MAX_BATCH = 32
+DELAY = 0.002
+
+# connections the listening socket holds before accept, a burst past it is refused
+BACKLOG = 1024
+
+# largest request body accepted
+MAX_BODY = 16 * 1024 * 1024
+
+ENDPOINTS = ["score", "distances", "msa"]
+
+_REASONS = {200: "OK", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed",
+            413: "Payload Too Large", 503: "Service Unavailable"}
+
+
+class RequestError(Exception):
+    pass
+
+
+# loads the engines and builds the table in a worker, so the first request does not pay for it
+def _warm(d):
+    import NW_Part1
+    import multiple_Sequence_Alignment_Modified
+    NW_Part1.Alignment.d = d
+    multiple_Sequence_Alignment_Modified.MultipleAlignment.d = d
+    a = NW_Part1.Alignment("HEAGAWGHEE", "PAWHEAE")
+    a.compute_alignment()
+    a.compute_score()
+    multiple_Sequence_Alignment_Modified.MultipleAlignment(workers=1).computeMultipleAlignment(
+        ["HEAGAWGHEE", "PAWHEAE", "HEAGAWGHE"])
+
+
+def _pid():
+    return os.getpid()
+
+
+# scores of a batch of score requests, requests with the same query aligned in one pass
+def _scores(payloads):
+    from NW_Part1 import Alignment
+    targets = {}
+    for k, payload in enumerate(payloads):
+        ys = payload["targets"] if "targets" in payload else [payload["y"]]
+        targets.setdefault(payload["x"], []).append((k, ys))
+    out = [None] * len(payloads)
+    for x, requests in targets.items():
+        scores = Alignment.score_many(x, [y for _, ys in requests for y in ys])
+        start = 0
+        for k, ys in requests:
+            part = scores[start:start + len(ys)]
+            start += len(ys)
+            out[k] = {"scores": part} if "targets" in payloads[k] else {"score": part[0]}
+    return out
+
+
+def _distances(payload):
+    from multiple_Sequence_Alignment_Modified import MultipleAlignment
+    matrix = MultipleAlignment(distance=payload.get("method", "kimura"), workers=1).distanceMatrix(
+        payload["sequences"])
+    return {"matrix": [[float(v) for v in row] for row in matrix]}
+
+
+def _msa(payload):
+    import refinement
+    from multiple_Sequence_Alignment_Modified import MultipleAlignment
+    a = MultipleAlignment(distance=payload.get("distance", "kimura"), linkage=payload.get("linkage", "complete"),
+                          workers=1,
+                          iterations=refinement.DEFAULT_ITERATIONS if payload.get("refine") else 0)
+    A = a.computeMultipleAlignment(payload["sequences"])
+    return {"alignment": A, "score": a.scoreMultipleAlignment(A)}
+
+
+# message for a failed request, MultipleAlignment.error exits with status 1 after printing it
+def _message(e):
+    return "alignment failed" if isinstance(e, SystemExit) else str(e)
+
+
+# runs a batch of requests of one endpoint in a worker, returns (result, error, seconds)
+# for each; an error only fails its own request
+def _run_batch(endpoint, payloads):
+    if endpoint == "score":
+        start = time.perf_counter()
+        try:
+            results = _scores(payloads)
+        except (ValueError, SystemExit) as e:
+            # one bad request fails the shared pass, so the requests are run again one at a time
+            if len(payloads) > 1:
+                return [_run_batch(endpoint, [payload])[0] for payload in payloads]
+            return [(None, _message(e), time.perf_counter() - start)]
+        seconds = (time.perf_counter() - start) / len(payloads)
+        return [(result, None, seconds) for result in results]
+    run = _distances if endpoint == "distances" else _msa
+    out = []
+    for payload in payloads:
+        start = time.perf_counter()
+        try:
+            out.append((run(payload), None, time.perf_counter() - start))
+        except (ValueError, SystemExit) as e:
+            out.append((None, _message(e), time.perf_counter() - start))
+    return out
+
+
+def _check_sequences(sequences, name):
+    if not isinstance(sequences, list) or not all(isinstance(s, str) for s in sequences):
+        raise RequestError(name + " must be a list of sequence strings")
+    try:
+        for seq in sequences:
+            substitution.encode(seq)
+    except ValueError as e:
+        raise RequestError(str(e))
+
+
+# checks a request body before it is queued, so bad requests never reach a worker
+def _validate(endpoint, payload):
+    if not isinstance(payload, dict):
+        raise RequestError("request body must be a JSON object")
+    if endpoint == "score":
+        if not isinstance(payload.get("x"), str):
+            raise RequestError("x must be a sequence string")
+        if "targets" in payload:
+            _check_sequences(payload["targets"], "targets")
+        elif not isinstance(payload.get("y"), str):
+            raise RequestError("y (or targets) must be a sequence string")
+        _check_sequences([payload["x"]] + payload.get("targets", [payload.get("y")]), "x and y")
+        return
+    _check_sequences(payload.get("sequences"), "sequences")
+    if endpoint == "distances" and payload.get("method", "kimura") not in ("kimura", "kmer"):
+        raise RequestError("method must be kimura or kmer")
+    if endpoint == "msa":
+        if payload.get("distance", "kimura") not in ("kimura", "kmer"):
+            raise RequestError("distance must be kimura or kmer")
+        if payload.get("linkage", "complete") not in ("complete", "average", "nj"):
+            raise RequestError("linkage must be complete, average or nj")
+
+
+class _Queued(object):
+    __slots__ = ("payload", "future", "arrived")
+
+    def __init__(self, payload, future):
+        self.payload = payload
+        self.future = future
+        self.arrived = time.perf_counter()
+
+
+class Service(object):
+
+    # workers defaults to the number of CPUs, d is the gap penalty every request is aligned with
+    def __init__(self, workers=None, d=8, max_pending=DEFAULT_MAX_PENDING, max_batch=MAX_BATCH, delay=DELAY):
+        self.workers = workers or os.cpu_count() or 1
+        self.d = d
+        self.max_pending = max_pending
+        self.max_batch = max_batch
+        self.delay = delay
+        self.pending = 0
+        self.served = 0
+        self.rejected = 0
+        self.pool = None
+        self.queues = {}
+        self.tasks = []
+        self.slots = None
+
+    # starts the pool and waits until every worker has loaded the engines
+    async def start(self):
+        loop = asyncio.get_running_loop()
+        self.pool = ProcessPoolExecutor(max_workers=self.workers, initializer=_warm, initargs=(self.d,))
+        # the pool starts its processes as tasks arrive, so one task per worker brings them all up
+        await asyncio.gather(*[loop.run_in_executor(self.pool, _pid) for _ in range(self.workers)])
+        # one batch per worker in flight, the rest of the requests wait in the queues
+        self.slots = asyncio.Semaphore(self.workers)
+        for endpoint in ENDPOINTS:
+            self.queues[endpoint] = asyncio.Queue()
+            self.tasks.append(asyncio.create_task(self._batcher(endpoint)))
+
+    async def stop(self):
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.pool.shutdown()
+
+    # collects batches of one endpoint's requests and runs them on the pool
+    async def _batcher(self, endpoint):
+        queue = self.queues[endpoint]
+        while True:
+            batch = [await queue.get()]
+            await self.slots.acquire()
+            deadline = time.perf_counter() + self.delay
+            while len(batch) < self.max_batch:
+                timeout = deadline - time.perf_counter()
+                if timeout <= 0 and queue.empty():
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(queue.get(), max(timeout, 0)))
+                except asyncio.TimeoutError:
+                    break
+            asyncio.create_task(self._run(endpoint, batch))
+
+    async def _run(self, endpoint, batch):
+        loop = asyncio.get_running_loop()
+        started = time.perf_counter()
+        try:
+            results = await loop.run_in_executor(self.pool, _run_batch, endpoint, [q.payload for q in batch])
+        except Exception as e:
+            results = [(None, "worker failed: %s" % e, 0.0)] * len(batch)
+        finally:
+            self.slots.release()
+        instrumentation.count("service_batches")
+        for queued, (result, error, seconds) in zip(batch, results):
+            if not queued.future.done():
+                queued.future.set_result((result, error, seconds, started - queued.arrived, len(batch)))
+
+    # answers one request, returns (status, body)
+    async def handle(self, method, path, body):
+        arrived = time.perf_counter()
+        endpoint = path.strip("/").split("?")[0]
+        if endpoint == "health":
+            return 200, {"pending": self.pending, "served": self.served, "rejected": self.rejected,
+                         "workers": self.workers, "d": self.d}
+        if endpoint not in ENDPOINTS:
+            return 404, {"error": "unknown endpoint " + path}
+        if method != "POST":
+            return 405, {"error": "use POST for /" + endpoint}
+        if self.pending >= self.max_pending:
+            self.rejected += 1
+            instrumentation.count("service_rejected")
+            return 503, {"error": "too many pending requests, retry later"}
+        try:
+            payload = json.loads(body or b"{}")
+            _validate(endpoint, payload)
+        except (ValueError, RequestError) as e:
+            return 400, {"error": str(e)}
+
+        self.pending += 1
+        try:
+            future = asyncio.get_running_loop().create_future()
+            await self.queues[endpoint].put(_Queued(payload, future))
+            result, error, seconds, queued, size = await future
+        finally:
+            self.pending -= 1
+        self.served += 1
+        instrumentation.count("service_requests")
+        timing = {"queued": queued, "compute": seconds, "total": time.perf_counter() - arrived, "batch": size}
+        if error is not None:
+            return 400, {"error": error, "timing": timing}
+        result["timing"] = timing
+        return 200, result
+
+    # serves HTTP/1.1 requests on one connection until the client closes it
+    async def connection(self, reader, writer):
+        try:
+            while True:
+                line = await reader.readline()
+                if not line.strip():
+                    break
+                try:
+                    method, path, _ = line.decode('latin-1').split(" ", 2)
+                except ValueError:
+                    await self._respond(writer, 400, {"error": "malformed request line"}, False)
+                    break
+                headers = {}
+                while True:
+                    header = await reader.readline()
+                    if header in (b"\r\n", b"\n", b""):
+                        break
+                    name, _, value = header.decode('latin-1').partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                keep = headers.get("connection", "").lower() != "close"
+                try:
+                    length = int(headers.get("content-length", 0) or 0)
+                    if length < 0:
+                        raise ValueError(length)
+                except ValueError:
+                    await self._respond(writer, 400, {"error": "malformed Content-Length"}, False)
+                    break
+                if length > MAX_BODY:
+                    await self._respond(writer, 413, {"error": "request body too large"}, False)
+                    break
+                body = await reader.readexactly(length) if length else b""
+                status, response = await self.handle(method.upper(), path, body)
+                await self._respond(writer, status, response, keep)
+                if not keep:
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    @staticmethod
+    async def _respond(writer, status, body, keep):
+        data = json.dumps(body).encode('utf-8')
+        head = ["HTTP/1.1 %d %s" % (status, _REASONS.get(status, "")),
+                "Content-Type: application/json",
+                "Content-Length: %d" % len(data),
+                "Connection: " + ("keep-alive" if keep else "close")]
+        if status == 503:
+            head.append("Retry-After: 1")
+        writer.write(("\r\n".join(head) + "\r\n\r\n").encode('latin-1') + data)
+        await writer.drain()
+
+
+async def serve(service, host="127.0.0.1", port=DEFAULT_PORT, socket=None):
+    await service.start()
+    if socket is not None:
+        server = await asyncio.start_unix_server(service.connection, path=socket, backlog=BACKLOG)
+        where = socket
+    else:
+        server = await asyncio.start_server(service.connection, host, port, backlog=BACKLOG)
+        where = "http://%s:%d" % (host, port)
+    print("serving on %s with %d workers" % (where, service.workers), flush=True)
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        await service.stop()
+        if socket is not None and os.path.exists(socket):
+            os.remove(socket)
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Local alignment service with a warm worker pool")
+    parser.add_argument("--host", default="127.0.0.1", help="address to listen on (default 127.0.0.1)")
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT, help="port to listen on (default %d)" % DEFAULT_PORT)
+    parser.add_argument("--socket", help="listen on this Unix socket instead of TCP")
+    parser.add_argument("--workers", type=int, help="worker processes (default: all CPUs)")
+    parser.add_argument("-d", type=int, default=8, help="gap penalty (default 8)")
+    parser.add_argument("--max-pending", type=int, default=DEFAULT_MAX_PENDING,
+                        help="requests admitted at once before answering 503 (default %d)" % DEFAULT_MAX_PENDING)
+    parser.add_argument("--trace", help="write timings and counters as JSON lines to this file")
+    args = parser.parse_args(argv)
+
+    log = instrumentation.log_to(args.trace) if args.trace else None
+    service = Service(args.workers, args.d, args.max_pending)
+    try:
+        asyncio.run(serve(service, args.host, args.port, args.socket))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if log is not None:
+            instrumentation.summary()
+            log.close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,123 @@
+import numpy as np
+
+import substitution
+from frequency_profile import column_counts
+
+"""
+Sum-of-pairs scoring from per-column residue counts.
+
+With c the counts of one column (residues and gap) and S the substitution
+table, the column's sum-of-pairs score is
+
+    (c . S . c - sum_a c_a * S[a, a]) / 2
+
+which costs O(A^2) per column however many sequences there are. SPScorer keeps
+the counts and per-column scores of an alignment so the score change of
+replacing some columns or one row, or of realigning a block of rows against
+the others, can be computed without rescoring it all.
+"""
+
+
+# sum-of-pairs score of every column given its counts
+def column_scores(counts, table):
+    pairs = ((counts @ table) * counts).sum(axis=1) - counts @ np.diag(table)
+    return pairs // 2
+
+
+# score of every column between two groups of rows (pairs with one row in each
+# group), given the counts of each group
+def cross_scores(countsA, countsB, table):
+    return ((countsA @ table) * countsB).sum(axis=1)
+
+
+# sum-of-pairs score of an alignment given as rows of codes or strings
+def sp_score(rows, table):
+    if not isinstance(rows, np.ndarray):
+        rows = substitution.encode_rows(rows)
+    if rows.size == 0:
+        return 0
+    return int(column_scores(column_counts(rows), table).sum())
+
+
+class SPScorer(object):
+
+    # rows is the alignment as a 2D array of codes (or a list of strings)
+    def __init__(self, rows, table):
+        if not isinstance(rows, np.ndarray):
+            rows = substitution.encode_rows(rows)
+        self.rows = rows.copy()
+        self.table = table
+        self.counts = column_counts(self.rows)
+        self.columns = column_scores(self.counts, table)
+        self.score = int(self.columns.sum())
+
+    # score change if the columns cols were replaced by block (one row per
+    # sequence, one column per entry of cols)
+    def delta_columns(self, cols, block):
+        cols = np.asarray(cols)
+        new = column_scores(column_counts(np.asarray(block)), self.table)
+        return int(new.sum() - self.columns[cols].sum())
+
+    def apply_columns(self, cols, block):
+        cols = np.asarray(cols)
+        block = np.asarray(block)
+        delta = self.delta_columns(cols, block)
+        self.rows[:, cols] = block
+        self.counts[cols] = column_counts(block)
+        self.columns[cols] = column_scores(self.counts[cols], self.table)
+        self.score += delta
+        return delta
+
+    # counts of the columns where row r would change to new_row, and those columns
+    def _row_change(self, r, new_row):
+        new_row = substitution.encode(new_row)
+        cols = np.flatnonzero(self.rows[r] != new_row)
+        counts = self.counts[cols].copy()
+        k = np.arange(len(cols))
+        counts[k, self.rows[r, cols]] -= 1
+        counts[k, new_row[cols]] += 1
+        return cols, counts, new_row
+
+    # score change if row r were replaced by new_row (same length)
+    def delta_row(self, r, new_row):
+        cols, counts, _ = self._row_change(r, new_row)
+        return int(column_scores(counts, self.table).sum() - self.columns[cols].sum())
+
+    def apply_row(self, r, new_row):
+        cols, counts, new_row = self._row_change(r, new_row)
+        new = column_scores(counts, self.table)
+        delta = int(new.sum() - self.columns[cols].sum())
+        self.rows[r] = new_row
+        self.counts[cols] = counts
+        self.columns[cols] = new
+        self.score += delta
+        return delta
+
+    # score between the rows lo:hi and the other rows
+    def cross(self, lo, hi):
+        inside = column_counts(self.rows[lo:hi])
+        return int(cross_scores(inside, self.counts - inside, self.table).sum())
+
+    # score change and column counts if the alignment were replaced by rows, the rows lo:hi
+    # realigned against the others by inserting all-gap columns into each group only
+    #
+    # the pairs inside each group keep their score (gap against gap scores 0), so only the
+    # score between the groups changes
+    def _split_change(self, lo, hi, rows):
+        inside = column_counts(rows[lo:hi])
+        counts = column_counts(rows)
+        new = int(cross_scores(inside, counts - inside, self.table).sum())
+        return new - self.cross(lo, hi), counts
+
+    def delta_split(self, lo, hi, rows):
+        return self._split_change(lo, hi, np.asarray(rows))[0]
+
+    # every column moves, so the per-column scores are made again from the new counts
+    def apply_split(self, lo, hi, rows):
+        rows = np.asarray(rows)
+        delta, counts = self._split_change(lo, hi, rows)
+        self.rows = rows.copy()
+        self.counts = counts
+        self.columns = column_scores(counts, self.table)
+        self.score += delta
+        return delta
@@ -0,0 +1,121 @@
+import numpy as np
+
+"""
+Substitution table shared by Alignment and MultipleAlignment.
+
+Residues A-Z and the gap character are mapped to small integer codes once per
+sequence (which is also where illegal characters are caught), and scores are
+read from a compact code-indexed table that already holds the residue/gap and
+gap/gap scores, so hot loops never touch characters or dictionaries.
+"""
+
+ALPHABET = "ABCDEFGHIJKLMNOPQRSTUVWXYZ"
+GAP = len(ALPHABET) # code used for '-'
+SIZE = GAP + 1 # codes per table row/column
+INVALID = 255 # code given to characters outside the alphabet
+
+# byte -> code lookup
+CODES = np.full(256, INVALID, dtype=np.uint8)
+for _k, _c in enumerate(ALPHABET):
+    CODES[ord(_c)] = _k
+CODES[ord('-')] = GAP
+
+# character -> code lookup for single characters
+CODE_OF = dict((c, k) for k, c in enumerate(ALPHABET + '-'))
+
+# code -> byte lookup used when turning codes back into strings
+CHARS = np.frombuffer((ALPHABET + '-').encode('ascii'), dtype=np.uint8)
+
+_blosum_50 = None
+_tables = {}
+
+
+# BLOSUM50 as a 2D int array indexed by residue code, residues missing from the
+# blosum package score 0 just like its default=0 lookup
+def blosum50_array():
+    global _blosum_50
+    if _blosum_50 is None:
+        import blosum as bl
+        table = bl.BLOSUM(50, default=0)
+        a = np.zeros((GAP, GAP), dtype=np.int64)
+        for i, x in enumerate(ALPHABET):
+            if x not in table:
+                continue
+            for j, y in enumerate(ALPHABET):
+                a[i, j] = int(table[x][y])
+        _blosum_50 = a
+    return _blosum_50
+
+
+class SubstitutionTable(object):
+    __slots__ = ("d", "scores", "residues", "rows")
+
+    # scores is the full code-indexed table: BLOSUM50 for residue pairs, -d for a
+    # residue against a gap and 0 for two gaps, residues is its residue-only part
+    def __init__(self, d):
+        self.d = d
+        self.scores = np.zeros((SIZE, SIZE), dtype=np.int64)
+        self.scores[:GAP, :GAP] = blosum50_array()
+        self.scores[GAP, :GAP] = -d
+        self.scores[:GAP, GAP] = -d
+        self.residues = self.scores[:GAP, :GAP]
+        # plain nested lists for per-character lookups, indexing numpy from Python is slower
+        self.rows = self.scores.tolist()
+
+    # score of two characters, None if either is not a residue or gap
+    def s(self, x, y):
+        a = code(x)
+        b = code(y)
+        if a == INVALID or b == INVALID:
+            return None
+        return self.rows[a][b]
+
+
+# code of a single character, INVALID if it is not a residue or gap
+def code(ch):
+    return CODE_OF.get(ch, INVALID)
+
+
+# shared table for gap penalty d, built on first use
+def table(d):
+    if d not in _tables:
+        _tables[d] = SubstitutionTable(d)
+    return _tables[d]
+
+
+# encodes a sequence string as an array of codes, this is the one place input is
+# validated, so anything that has been encoded can be indexed into a table directly
+def encode(seq):
+    if isinstance(seq, np.ndarray):
+        return seq
+    try:
+        raw = seq.encode('ascii')
+    except UnicodeEncodeError:
+        raise ValueError("illegal character in sequence " + repr(seq))
+    codes = CODES[np.frombuffer(raw, dtype=np.uint8)]
+    if (codes == INVALID).any():
+        raise ValueError("illegal character in sequence " + repr(seq))
+    return codes
+
+
+# whether obj is a single sequence (a string or a 1D array of codes) rather than a list of them
+def is_sequence(obj):
+    return isinstance(obj, str) or (isinstance(obj, np.ndarray) and obj.ndim == 1)
+
+
+# encodes rows of equal length (only the first n characters of each when n is
+# given) into one 2D array of codes
+def encode_rows(rows, n=None):
+    if n is None:
+        n = len(rows[0]) if rows else 0
+    codes = np.empty((len(rows), n), dtype=np.uint8)
+    k = 0
+    while k < len(rows):
+        codes[k] = encode(rows[k][:n])
+        k += 1
+    return codes
+
+
+# turns an array of codes back into a string
+def decode(codes):
+    return CHARS[codes].tobytes().decode('ascii')
@@ -0,0 +1,186 @@
+import math
+
+import numpy as np
+
+import dp_scores
+import instrumentation
+from dp_engine import fill_row, DIAG, LEFT, TOP
+
+"""
+Compact traceback storage for Needleman-Wunsch fills.
+
+The traceback only needs the one move each cell resolves to, so instead of a
+uint8 of direction bits per cell next to a full int64 F matrix (9 bytes a
+cell), PackedMoves keeps 2 bits per cell, four cells to a byte, and the fill
+keeps only its current row of F: 0.25 bytes a cell.
+
+The checkpointed variant keeps no moves at all, only every k-th row of F.
+The traceback walks back one block of k rows at a time, refilling the block
+from the checkpoint above it (only up to the current column) to get its
+moves, so memory is about (n / k) * m * 8 + k * m bytes for one extra fill.
+
+Moves are resolved with the same priority as the engine's traceback, so the
+alignments are identical to the full-matrix ones.
+"""
+
+# move priorities, highest first, of dp_engine.pairwise_move and frequency_profile.profile_move
+PAIRWISE = (DIAG, LEFT, TOP)
+PROFILE = (LEFT, TOP, DIAG)
+
+# 2-bit codes of the moves and back
+_CODE = np.zeros(DIAG + 1, dtype=np.uint8)
+_CODE[TOP] = 1
+_CODE[LEFT] = 2
+_CODE[DIAG] = 3
+_MOVE = [0, TOP, LEFT, DIAG]
+
+
+# move each combination of direction bits resolves to under a priority order
+def _resolved(order):
+    table = np.empty(DIAG * 2, dtype=np.uint8)
+    for bits in range(DIAG * 2):
+        table[bits] = next((move for move in order if bits & move), order[-1])
+    return table
+
+
+_RESOLVED = {PAIRWISE: _resolved(PAIRWISE), PROFILE: _resolved(PROFILE)}
+
+# 2-bit code each combination of direction bits resolves to
+_RESOLVED_CODE = {order: _CODE[moves] for order, moves in _RESOLVED.items()}
+
+
+# the one move of every cell of a row of direction bits, first column TOP
+def resolve(bits, order):
+    moves = _RESOLVED[order][bits]
+    moves[0] = TOP
+    return moves
+
+
+class PackedMoves(object):
+    __slots__ = ("data", "n", "m")
+
+    # moves of an (n + 1) x (m + 1) matrix, row 0 all LEFT
+    def __init__(self, n, m):
+        self.n = n
+        self.m = m
+        self.data = np.zeros((n + 1, (m + 4) // 4), dtype=np.uint8)
+        row = np.full(m + 1, LEFT, dtype=np.uint8)
+        row[0] = 0
+        self.set_row(0, row)
+
+    def set_row(self, i, moves):
+        codes = np.zeros(self.data.shape[1] * 4, dtype=np.uint8)
+        codes[:len(moves)] = _CODE[moves]
+        self.set_codes(i, codes)
+
+    # stores a row given as 2-bit codes, padded to a multiple of 4 cells
+    def set_codes(self, i, codes):
+        codes = codes.reshape(-1, 4)
+        packed = self.data[i]
+        np.left_shift(codes[:, 3], 6, out=packed)
+        packed |= codes[:, 2] << 4
+        packed |= codes[:, 1] << 2
+        packed |= codes[:, 0]
+
+    def move(self, i, j):
+        return _MOVE[(int(self.data[i, j >> 2]) >> ((j & 3) << 1)) & 3]
+
+    # list of moves from the top left to the bottom right corner
+    def traceback(self):
+        i = self.n
+        j = self.m
+        # a memoryview reads single bytes far faster than indexing the array
+        data = memoryview(self.data.reshape(-1))
+        stride = self.data.shape[1]
+        ops = []
+        while i + j > 0:
+            op = _MOVE[(data[i * stride + (j >> 2)] >> ((j & 3) << 1)) & 3]
+            ops.append(op)
+            if op != LEFT:
+                i -= 1
+            if op != TOP:
+                j -= 1
+        ops.reverse()
+        return np.array(ops, dtype=np.uint8)
+
+
+# fills rows r0 + 1 .. r1 of F from row r0 (columns 0 .. width - 1 only) and returns
+# the last row and the moves of every filled row
+def _fill_rows(scores, row, r0, r1, width, order):
+    row = row[:width]
+    left = scores.left[:width - 1]
+    moves = np.empty((r1 - r0, width), dtype=np.uint8)
+    i = r0 + 1
+    while i <= r1:
+        diag = scores.diag_row(i, width)
+        row, bits = fill_row(row, scores.first_col[i], diag, scores.top[i - 1], left)
+        moves[i - r0 - 1] = resolve(bits, order)
+        i += 1
+    return row, moves
+
+
+# fills the matrix of scores (a dp_scores.PairScores or ProfileScores) keeping one
+# row of F, returns the score and the PackedMoves
+def fill_packed(scores, order):
+    n = len(scores.top)
+    m = len(scores.left)
+    packed = PackedMoves(n, m)
+    row = scores.first_row
+    left = scores.left
+    lookup = _RESOLVED_CODE[order]
+    codes = np.zeros(packed.data.shape[1] * 4, dtype=np.uint8)
+    i = 1
+    while i <= n:
+        row, bits = fill_row(row, scores.first_col[i], scores.diag_row(i, m + 1), scores.top[i - 1], left)
+        np.take(lookup, bits, out=codes[:m + 1])
+        codes[0] = _CODE[TOP]
+        packed.set_codes(i, codes)
+        i += 1
+    if instrumentation.enabled:
+        dp_scores.count_fill(scores, (n + 1) * (m + 1), packed.data.nbytes + row.nbytes + codes.nbytes)
+    return int(row[-1]), packed
+
+
+# moves of the optimal alignment keeping only every k-th row of F (default about
+# sqrt(n) rows apart), returns the score and the moves
+#
+# the cells counted include the blocks filled again during the traceback
+def align_checkpointed(scores, order, k=None):
+    n = len(scores.top)
+    m = len(scores.left)
+    if k is None:
+        k = max(1, int(math.isqrt(n)))
+    checkpoints = [scores.first_row]
+    row = scores.first_row
+    r = 0
+    while r < n:
+        r1 = min(n, r + k)
+        row, _ = _fill_rows(scores, row, r, r1, m + 1, order)
+        if r1 < n:
+            checkpoints.append(row)
+        r = r1
+    score = int(row[-1])
+    cells = (n + 1) * (m + 1)
+    largest = 0
+
+    i = n
+    j = m
+    ops = []
+    while i > 0:
+        # block of rows start + 1 .. i, refilled from the checkpoint at row start
+        start = ((i - 1) // k) * k
+        _, moves = _fill_rows(scores, checkpoints[start // k], start, i, j + 1, order)
+        cells += moves.size
+        largest = max(largest, moves.nbytes)
+        while i > start and i + j > 0:
+            op = moves[i - start - 1, j]
+            ops.append(op)
+            if op != LEFT:
+                i -= 1
+            if op != TOP:
+                j -= 1
+    ops.extend([LEFT] * j)
+    ops.reverse()
+    if instrumentation.enabled:
+        dp_scores.count_fill(scores, cells, sum(row.nbytes for row in checkpoints) + largest)
+    return score, np.array(ops, dtype=np.uint8)
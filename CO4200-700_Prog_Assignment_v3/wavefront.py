@@ -0,0 +1,138 @@
+import os
+from concurrent.futures import ProcessPoolExecutor, wait
+from multiprocessing import shared_memory
+
+import numpy as np
+
+import dp_scores
+import instrumentation
+from dp_engine import fill_row, LEFT, TOP
+
+"""
+Tiled wavefront fill of one large DP matrix on several processes.
+
+F is cut into tiles of BLOCK x BLOCK cells. A tile only needs the F row just
+above it and the F column just left of it, so all tiles on one anti-diagonal
+of the tile grid are independent. They run on a process pool one
+anti-diagonal at a time; the pool's processes share three arrays through
+multiprocessing.shared_memory:
+
+    H[k]  the F row below tile row k - 1 (H[0] is row 0 of F)
+    V[k]  the F column right of tile column k - 1 (V[0] is column 0 of F)
+    P     the direction bits of every cell, each tile writing its own part
+
+so only tile boundaries pass between processes and F itself is never held.
+Every row segment is filled by dp_engine.fill_row from the true F values to
+its left and above, so F and P are exactly those of the serial fill.
+"""
+
+BLOCK = 512
+
+# below this many cells the pool costs more than it saves
+PARALLEL_CELLS = 4000000
+
+_scores = None
+_arrays = None
+
+
+# tile boundaries covering cells 1 .. size
+def _bounds(size, block):
+    return list(range(1, size + 1, block)) + [size + 1]
+
+
+# fills tile (bi, bj) from its boundaries in H and V, writes its bits to P and its
+# bottom row and right column back to H and V
+def _tile(scores, H, V, P, rows, cols, bi, bj):
+    r0, r1 = rows[bi], rows[bi + 1]
+    c0, c1 = cols[bj], cols[bj + 1]
+    prev = H[bi, c0 - 1:c1].copy()
+    first = V[bj, r0:r1]
+    diag = scores.diag(r0, r1, c0, c1)
+    left = scores.left[c0 - 1:c1 - 1]
+    k = 0
+    while k < r1 - r0:
+        i = r0 + k
+        prev, bits = fill_row(prev, first[k], diag[k], scores.top[i - 1], left)
+        P[i, c0:c1] = bits[1:]
+        V[bj + 1, i] = prev[-1]
+        k += 1
+    H[bi + 1, c0:c1] = prev[1:]
+
+
+def _attach(name, shape, dtype):
+    memory = shared_memory.SharedMemory(name=name)
+    return memory, np.ndarray(shape, dtype=dtype, buffer=memory.buf)
+
+
+def _init_worker(scores, layout):
+    global _scores, _arrays
+    _scores = scores
+    _arrays = [_attach(*spec) for spec in layout]
+
+
+def _run_tile(rows, cols, bi, bj):
+    (_, H), (_, V), (_, P) = _arrays
+    _tile(_scores, H, V, P, rows, cols, bi, bj)
+
+
+def _shared(shape, dtype):
+    memory = shared_memory.SharedMemory(create=True, size=max(1, int(np.prod(shape)) * np.dtype(dtype).itemsize))
+    return memory, np.ndarray(shape, dtype=dtype, buffer=memory.buf)
+
+
+# fills the DP matrix of scores (a dp_scores.PairScores or ProfileScores), returns the score of the
+# bottom right cell and the direction bits P of the whole matrix
+#
+# workers defaults to the number of CPUs; small matrices and workers=1 fill the tiles in
+# order in this process
+def fill(scores, workers=None, block=BLOCK):
+    n = len(scores.top)
+    m = len(scores.left)
+    if workers is None:
+        workers = os.cpu_count() or 1
+    rows = _bounds(n, block)
+    cols = _bounds(m, block)
+    shapes = [((len(rows), m + 1), np.int64), ((len(cols), n + 1), np.int64), ((n + 1, m + 1), np.uint8)]
+    parallel = workers > 1 and (n + 1) * (m + 1) >= PARALLEL_CELLS and len(rows) > 2 and len(cols) > 2
+    if parallel:
+        memories = [_shared(shape, dtype) for shape, dtype in shapes]
+        H, V, P = [view for _, view in memories]
+        memories = [memory for memory, _ in memories]
+    else:
+        memories = []
+        H, V, P = [np.empty(shape, dtype=dtype) for shape, dtype in shapes]
+    if instrumentation.enabled:
+        dp_scores.count_fill(scores, (n + 1) * (m + 1), H.nbytes + V.nbytes + P.nbytes)
+    try:
+        H[0] = scores.first_row
+        V[0] = scores.first_col
+        H[1:, 0] = scores.first_col[np.array(rows[1:], dtype=np.int64) - 1]
+        V[1:, 0] = scores.first_row[np.array(cols[1:], dtype=np.int64) - 1]
+        P[0] = LEFT
+        P[:, 0] = TOP
+        P[0, 0] = 0
+        tiles_r = len(rows) - 1
+        tiles_c = len(cols) - 1
+        if not parallel:
+            for bi in range(tiles_r):
+                for bj in range(tiles_c):
+                    _tile(scores, H, V, P, rows, cols, bi, bj)
+            return int(H[-1, m]), P
+
+        layout = [(memory.name, shape, dtype) for memory, (shape, dtype) in zip(memories, shapes)]
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                                 initargs=(scores, layout)) as pool:
+            # tile (bi, bj) is on anti-diagonal bi + bj, which only needs the one before it
+            for k in range(tiles_r + tiles_c - 1):
+                futures = [pool.submit(_run_tile, rows, cols, bi, k - bi)
+                           for bi in range(max(0, k - tiles_c + 1), min(k, tiles_r - 1) + 1)]
+                wait(futures)
+                for future in futures:
+                    future.result()
+        return int(H[-1, m]), P.copy()
+    finally:
+        # the views have to go before the memory they look into can be closed
+        del H, V, P
+        for memory in memories:
+            memory.close()
+            memory.unlink()